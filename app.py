@@ -3,16 +3,33 @@ import random
 import time
 import sqlite3
 import os
+import json
+import math
+import csv
+import io
 import secrets
 import hashlib
 import requests
-from flask import Flask, render_template, redirect, url_for, request, session, flash, g, jsonify
+import numpy as np
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, Response, render_template, redirect, url_for, request, session, flash, g, jsonify
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy import event, func, select, delete, literal, bindparam, tuple_, false, inspect, text, schema
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import make_transient_to_detached
 from apscheduler.schedulers.background import BackgroundScheduler
-from threading import Thread
+from apscheduler.schedulers.blocking import BlockingScheduler
+from threading import Thread, Lock
 import atexit
+import asyncio
+import heapq
+from collections import OrderedDict, deque, namedtuple
 from functools import wraps
 from datetime import datetime, timedelta
+from statistics import NormalDist
 
 # Create the Flask application instance
 app = Flask(__name__)
@@ -20,9 +37,61 @@ app = Flask(__name__)
 app.secret_key = secrets.token_hex(16)
 
 # --- Database setup functions ---
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///database.db'
+# DATABASE_URL picks the storage profile: a SQLite file (the default) or a PostgreSQL server.
+DATABASE_URL = os.environ.get('DATABASE_URL', 'sqlite:///database.db')
+if DATABASE_URL.startswith('postgres://'):
+    DATABASE_URL = 'postgresql://' + DATABASE_URL[len('postgres://'):]
+
+# SQLite profile: WAL lets the dashboards keep reading while the scheduler's tick commits,
+# and synchronous=NORMAL is still crash-safe in WAL mode.
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000)),
+    'mmap_size': int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)),
+    'cache_size': int(os.environ.get('SQLITE_CACHE_SIZE', -64000)),  # negative = KiB, so 64 MB
+    'temp_store': 'MEMORY',
+}
+
+# PostgreSQL profile: one pool per worker process, sized for the request threads plus the scheduler.
+POSTGRES_POOL_OPTIONS = {
+    'pool_size': int(os.environ.get('DB_POOL_SIZE', 10)),
+    'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 20)),
+    'pool_timeout': int(os.environ.get('DB_POOL_TIMEOUT', 10)),
+    'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+    'pool_pre_ping': True,
+}
+
+def storage_profile(url):
+    return 'postgresql' if url.startswith('postgresql') else 'sqlite'
+
+def storage_engine_options(url):
+    """Engine keyword arguments for the profile that matches the database URL."""
+    if storage_profile(url) == 'postgresql':
+        return dict(POSTGRES_POOL_OPTIONS)
+    # The pragmas handle lock waits; the driver timeout only covers opening the connection.
+    return {'connect_args': {'timeout': SQLITE_PRAGMAS['busy_timeout'] / 1000, 'check_same_thread': False}}
+
+def apply_sqlite_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {name}={value}")
+    cursor.close()
+
+def configure_storage(engine):
+    """Hook the SQLite pragmas onto every new connection from this engine."""
+    if engine.dialect.name == 'sqlite':
+        event.listen(engine, 'connect', apply_sqlite_pragmas)
+    return engine
+
+app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = storage_engine_options(DATABASE_URL)
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 db = SQLAlchemy(app)
+with app.app_context():
+    configure_storage(db.engine)
 
 # --- Stock Market API Configuration ---
 STOCK_SYMBOLS = ['AAPL', 'GOOG', 'MSFT', 'AMZN', 'TSLA', 'NFLX', 'SBUX', 'NKE', 'KO']
@@ -68,7 +137,13 @@ class UserWallet(db.Model):
     __tablename__ = 'user_wallets'
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), unique=True, nullable=False)
-    balance = db.Column(db.Float, default=0.00)
+    # Cache of the account's ledger balance, moved by the same cents as each posted entry
+    balance_cents = db.Column(db.BigInteger, nullable=False, default=0, server_default='0')
+
+    @property
+    def balance(self):
+        """The balance in dollars, for display."""
+        return self.balance_cents / 100
 
 class Transaction(db.Model):
     __tablename__ = 'transactions'
@@ -77,6 +152,9 @@ class Transaction(db.Model):
     transaction_type = db.Column(db.String(100), nullable=False)
     amount = db.Column(db.Float, nullable=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    __table_args__ = (
+        db.Index('ix_transactions_user_timestamp', 'user_id', 'timestamp', 'id'),
+    )
 
 class StockHolding(db.Model):
     __tablename__ = 'stock_holdings'
@@ -85,6 +163,9 @@ class StockHolding(db.Model):
     symbol = db.Column(db.String(10), nullable=False)
     quantity = db.Column(db.Integer, nullable=False)
     cost_basis = db.Column(db.Float, nullable=False)
+    __table_args__ = (
+        db.Index('ux_stock_holdings_user_symbol', 'user_id', 'symbol', unique=True),
+    )
 
 class PasswordResetToken(db.Model):
     __tablename__ = 'password_reset_tokens'
@@ -92,49 +173,789 @@ class PasswordResetToken(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     token = db.Column(db.String(64), unique=True, nullable=False)
     expires_at = db.Column(db.DateTime, nullable=False)
+    __table_args__ = (
+        db.Index('ix_password_reset_tokens_expires_at', 'expires_at'),
+    )
+
+class ApiToken(db.Model):
+    __tablename__ = 'api_tokens'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)
+    # Only the SHA-256 of the token is stored; the token itself is shown once, at creation
+    token_hash = db.Column(db.String(64), unique=True, nullable=False)
+    name = db.Column(db.String(80), nullable=False, default='')
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
 class StockPrice(db.Model):
     __tablename__ = 'stock_prices'
     symbol = db.Column(db.String(10), primary_key=True)
     price = db.Column(db.Float, nullable=False)
+    # The tick that last moved the price, so other processes can pull just the changes
+    seq = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    __table_args__ = (
+        db.Index('ix_stock_prices_seq', 'seq'),
+    )
+
+class PriceTick(db.Model):
+    __tablename__ = 'price_ticks'
+    id = db.Column(db.Integer, primary_key=True)
+    symbol = db.Column(db.String(10), nullable=False)
+    price = db.Column(db.Float, nullable=False)
+    recorded_at = db.Column(db.Integer, nullable=False)  # Unix seconds keeps the rows small
+    __table_args__ = (
+        db.Index('ix_price_ticks_symbol_recorded_at', 'symbol', 'recorded_at'),
+        db.Index('ix_price_ticks_recorded_at', 'recorded_at'),
+    )
+
+class PriceCandle(db.Model):
+    __tablename__ = 'price_candles'
+    id = db.Column(db.Integer, primary_key=True)
+    symbol = db.Column(db.String(10), nullable=False)
+    interval = db.Column(db.String(3), nullable=False)
+    bucket_start = db.Column(db.Integer, nullable=False)
+    open = db.Column(db.Float, nullable=False)
+    high = db.Column(db.Float, nullable=False)
+    low = db.Column(db.Float, nullable=False)
+    close = db.Column(db.Float, nullable=False)
+    tick_count = db.Column(db.Integer, nullable=False, default=0)
+    __table_args__ = (
+        db.Index('ux_price_candles_symbol_interval_bucket', 'symbol', 'interval', 'bucket_start', unique=True),
+        db.Index('ix_price_candles_interval_bucket', 'interval', 'bucket_start'),
+    )
+
+class ExchangeBalanceDelta(db.Model):
+    __tablename__ = 'exchange_balance_deltas'
+    id = db.Column(db.Integer, primary_key=True)
+    amount = db.Column(db.Float, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class LedgerJournal(db.Model):
+    __tablename__ = 'ledger_journals'
+    id = db.Column(db.Integer, primary_key=True)
+    entry_type = db.Column(db.String(30), nullable=False)  # e.g. 'deposit', 'buy', 'order_fill'
+    symbol = db.Column(db.String(10))
+    quantity = db.Column(db.Integer)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class LedgerEntry(db.Model):
+    __tablename__ = 'ledger_entries'
+    id = db.Column(db.Integer, primary_key=True)
+    journal_id = db.Column(db.Integer, db.ForeignKey('ledger_journals.id'), nullable=False)
+    account_id = db.Column(db.Integer, nullable=False)  # A user id, or one of the system accounts below
+    amount_cents = db.Column(db.BigInteger, nullable=False)
+    # Set once the entry is folded into its account's BalanceSnapshot; the rest are the tail
+    snapshotted = db.Column(db.Boolean, nullable=False, default=False, server_default=false())
+    __table_args__ = (
+        db.Index('ix_ledger_entries_account_id', 'account_id', 'id'),
+        db.Index('ix_ledger_entries_journal_id', 'journal_id'),
+        db.Index('ix_ledger_entries_unsnapshotted', 'snapshotted', 'account_id'),
+    )
+
+class BalanceSnapshot(db.Model):
+    __tablename__ = 'balance_snapshots'
+    account_id = db.Column(db.Integer, primary_key=True)
+    balance_cents = db.Column(db.BigInteger, nullable=False)
+    last_entry_id = db.Column(db.Integer, nullable=False)  # Highest entry id folded in so far
+    taken_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class LimitOrder(db.Model):
+    __tablename__ = 'limit_orders'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    symbol = db.Column(db.String(10), nullable=False)
+    side = db.Column(db.String(4), nullable=False)  # 'buy' or 'sell'
+    limit_price = db.Column(db.Float, nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    remaining = db.Column(db.Integer, nullable=False)
+    reserved = db.Column(db.Float, nullable=False, default=0.0)  # Cash still held back for a buy
+    cost_basis = db.Column(db.Float, nullable=False, default=0.0)  # Basis of the shares held back for a sell
+    status = db.Column(db.String(10), nullable=False, default='open')
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    __table_args__ = (
+        db.Index('ix_limit_orders_status_symbol', 'status', 'symbol'),
+        db.Index('ix_limit_orders_user_status', 'user_id', 'status'),
+    )
+
+class OrderBookVersion(db.Model):
+    """Bumped by every change to a symbol's open orders, so a worker can tell its in-memory book is stale."""
+    __tablename__ = 'order_book_versions'
+    symbol = db.Column(db.String(10), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+class ConditionalOrder(db.Model):
+    __tablename__ = 'conditional_orders'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    symbol = db.Column(db.String(10), nullable=False)
+    kind = db.Column(db.String(20), nullable=False)  # 'stop_loss', 'take_profit' or 'limit_buy'
+    trigger_price = db.Column(db.Float, nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    status = db.Column(db.String(10), nullable=False, default='pending')
+    executed_price = db.Column(db.Float)
+    executed_at = db.Column(db.DateTime)
+    note = db.Column(db.String(200))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    __table_args__ = (
+        db.Index('ix_conditional_orders_user_status', 'user_id', 'status'),
+        db.Index('ix_conditional_orders_status_id', 'status', 'id'),
+    )
+
+class OrderFill(db.Model):
+    __tablename__ = 'order_fills'
+    id = db.Column(db.Integer, primary_key=True)
+    symbol = db.Column(db.String(10), nullable=False)
+    price = db.Column(db.Float, nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    # NULL once that side's account is deleted; the fill stays in the other side's history
+    buy_order_id = db.Column(db.Integer, db.ForeignKey('limit_orders.id'), nullable=True)
+    sell_order_id = db.Column(db.Integer, db.ForeignKey('limit_orders.id'), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    __table_args__ = (
+        db.Index('ix_order_fills_buy_order_id', 'buy_order_id'),
+        db.Index('ix_order_fills_sell_order_id', 'sell_order_id'),
+    )
+
+class PortfolioRisk(db.Model):
+    __tablename__ = 'portfolio_risk'
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)  # Only the latest day is kept
+    as_of = db.Column(db.Date, nullable=False)
+    holdings_key = db.Column(db.String(64), nullable=False)  # Fingerprint of the holdings the metrics were built on
+    metrics = db.Column(db.Text, nullable=False)  # JSON
+    computed_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class SchemaMigration(db.Model):
+    __tablename__ = 'schema_migrations'
+    version = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(200), nullable=False)
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# --- Schema Migrations ---
+# create_all() only adds missing tables, so anything that changes an existing table
+# (indexes, constraints, data fixes) goes here. Append new steps; never reorder or edit applied ones.
+def create_model_index(conn, model, name):
+    index = next(index for index in model.__table__.indexes if index.name == name)
+    index.create(conn, checkfirst=True)
+
+def migrate_transactions_user_timestamp(conn):
+    create_model_index(conn, Transaction, 'ix_transactions_user_timestamp')
+
+def migrate_unique_stock_holdings(conn):
+    """Fold duplicate (user_id, symbol) rows into the oldest one, then enforce uniqueness."""
+    holdings = StockHolding.__table__
+    duplicates = conn.execute(
+        select(
+            holdings.c.user_id, holdings.c.symbol, func.min(holdings.c.id),
+            func.sum(holdings.c.quantity), func.sum(holdings.c.quantity * holdings.c.cost_basis),
+        )
+        .group_by(holdings.c.user_id, holdings.c.symbol)
+        .having(func.count() > 1)
+    ).all()
+    for user_id, symbol, keep_id, quantity, total_cost in duplicates:
+        conn.execute(
+            holdings.update().where(holdings.c.id == keep_id)
+            .values(quantity=quantity, cost_basis=total_cost / quantity if quantity else 0.0)
+        )
+        conn.execute(holdings.delete().where(
+            holdings.c.user_id == user_id, holdings.c.symbol == symbol, holdings.c.id != keep_id
+        ))
+    create_model_index(conn, StockHolding, 'ux_stock_holdings_user_symbol')
+
+def migrate_password_reset_expiry(conn):
+    create_model_index(conn, PasswordResetToken, 'ix_password_reset_tokens_expires_at')
+
+def migrate_ledger_snapshot_marks(conn):
+    """Mark entries as folded into a snapshot instead of relying on an id watermark."""
+    if 'snapshotted' not in {column['name'] for column in inspect(conn).get_columns('ledger_entries')}:
+        conn.execute(text('ALTER TABLE ledger_entries ADD COLUMN snapshotted BOOLEAN NOT NULL DEFAULT false'))
+        # Snapshots used to advance together, so the lowest watermark covers every account
+        watermark = conn.execute(select(func.min(BalanceSnapshot.last_entry_id))).scalar()
+        if watermark is not None:
+            entries = LedgerEntry.__table__
+            conn.execute(entries.update().where(entries.c.id <= watermark).values(snapshotted=True))
+    create_model_index(conn, LedgerEntry, 'ix_ledger_entries_unsnapshotted')
+
+def migrate_conditional_orders_status_id(conn):
+    create_model_index(conn, ConditionalOrder, 'ix_conditional_orders_status_id')
+
+def migrate_order_fills_nullable_orders(conn):
+    """Let a fill outlive one side's orders, and index fills by order."""
+    if not all(column['nullable'] for column in inspect(conn).get_columns('order_fills') if column['name'] in ('buy_order_id', 'sell_order_id')):
+        if conn.dialect.name == 'postgresql':
+            conn.execute(text('ALTER TABLE order_fills ALTER COLUMN buy_order_id DROP NOT NULL'))
+            conn.execute(text('ALTER TABLE order_fills ALTER COLUMN sell_order_id DROP NOT NULL'))
+        else:
+            # SQLite can't drop NOT NULL in place, so rebuild the table from the model
+            columns = ', '.join(column.name for column in OrderFill.__table__.columns)
+            conn.execute(text('ALTER TABLE order_fills RENAME TO order_fills_old'))
+            conn.execute(schema.CreateTable(OrderFill.__table__))
+            conn.execute(text(f'INSERT INTO order_fills ({columns}) SELECT {columns} FROM order_fills_old'))
+            conn.execute(text('DROP TABLE order_fills_old'))
+    create_model_index(conn, OrderFill, 'ix_order_fills_buy_order_id')
+    create_model_index(conn, OrderFill, 'ix_order_fills_sell_order_id')
+
+def migrate_wallet_balance_cents(conn):
+    """Replace the Float wallet balance with integer cents taken from the ledger."""
+    columns = {column['name'] for column in inspect(conn).get_columns('user_wallets')}
+    if 'balance' not in columns:
+        return
+    if 'balance_cents' not in columns:
+        conn.execute(text('ALTER TABLE user_wallets ADD COLUMN balance_cents BIGINT NOT NULL DEFAULT 0'))
+    ledger = dict(conn.execute(ledger_balances_query()).all())
+    exchange_id = conn.execute(select(User.id).where(User.username == 'Global_Exchange')).scalar()
+    rows = [
+        # The exchange's ledger balance also covers its pending deltas, so its wallet keeps its own figure.
+        # Before open_ledger() has run the ledger is empty and opens from these figures instead.
+        {'b_user_id': user_id, 'b_cents': ledger[user_id] if user_id in ledger and user_id != exchange_id else to_cents(balance or 0.0)}
+        for user_id, balance in conn.execute(text('SELECT user_id, balance FROM user_wallets'))
+    ]
+    if rows:
+        wallets = UserWallet.__table__
+        conn.execute(wallets.update().where(wallets.c.user_id == bindparam('b_user_id')).values(balance_cents=bindparam('b_cents')), rows)
+    conn.execute(text('ALTER TABLE user_wallets DROP COLUMN balance'))
+
+def migrate_stock_prices_seq(conn):
+    if 'seq' not in {column['name'] for column in inspect(conn).get_columns('stock_prices')}:
+        conn.execute(text('ALTER TABLE stock_prices ADD COLUMN seq INTEGER NOT NULL DEFAULT 0'))
+    create_model_index(conn, StockPrice, 'ix_stock_prices_seq')
+
+MIGRATIONS = [
+    (1, 'Index transactions by user and timestamp', migrate_transactions_user_timestamp),
+    (2, 'Merge duplicate holdings and make (user_id, symbol) unique', migrate_unique_stock_holdings),
+    (3, 'Index password reset tokens by expiry', migrate_password_reset_expiry),
+    (4, 'Mark ledger entries folded into balance snapshots', migrate_ledger_snapshot_marks),
+    (5, 'Index conditional orders by status and id', migrate_conditional_orders_status_id),
+    (6, 'Keep order fills when one side is deleted', migrate_order_fills_nullable_orders),
+    (7, 'Keep wallet balances in integer cents', migrate_wallet_balance_cents),
+    (8, 'Number stock prices by the tick that last moved them', migrate_stock_prices_seq),
+]
+
+def migrate_database():
+    """Create missing tables, then apply pending migrations, each in its own transaction."""
+    db.create_all()
+    versions = SchemaMigration.__table__
+    with db.engine.connect() as conn:
+        applied = set(conn.execute(select(versions.c.version)).scalars())
+    pending = [migration for migration in MIGRATIONS if migration[0] not in applied]
+    for version, name, migration in pending:
+        try:
+            with db.engine.begin() as conn:
+                migration(conn)
+                conn.execute(versions.insert().values(version=version, name=name))
+        except IntegrityError:
+            with db.engine.connect() as conn:
+                if conn.execute(select(versions.c.version).where(versions.c.version == version)).first() is None:
+                    raise
+            # Another worker applied it first
+            continue
+        print(f"Applied migration {version}: {name}")
+    # Workers that start without __main__ (flask run, gunicorn) then only ever read these rows
+    exchange_account.resolve()
+    return len(pending)
 
 # In-memory dictionary to simulate real-time stock prices
 stock_prices = {}
-global_exchange_user_id = None
+
+# --- Price Tick Engine ---
+PRICE_FLOOR = 1.0  # Prices never drop below $1.00
+MAX_TICK_CHANGE = 0.02  # Each tick moves a price by at most +/-2%
+INITIAL_PRICE_RANGE = (50.0, 200.0)
+
+class PriceTickEngine:
+    """Holds every simulated price in one NumPy array and moves them all at once.
+
+    Symbols keep a fixed position in the array, so a tick is a single vectorized
+    draw plus a multiply, floor and round over the whole universe. Every applied
+    tick bumps a sequence number and stamps the symbols whose price moved, which
+    is what lets pollers ask for just the changes since a tick they have seen.
+    """
+
+    def __init__(self, seed=None):
+        self.rng = np.random.default_rng(seed)
+        self.symbols = []
+        self.index = {}
+        self.prices = np.empty(0, dtype=np.float64)
+        self.changed_seq = np.empty(0, dtype=np.int64)
+        self.seq = 0
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.symbols)
+
+    def load(self, prices, seq=None, stamps=None):
+        """Replace the universe with a {symbol: price} mapping.
+
+        Prices read from the database come with the seq of the latest tick and
+        the tick each symbol last moved on (`stamps`), so every process numbers
+        ticks the same way. Without them the load counts as a tick that moved
+        everything.
+        """
+        with self.lock:
+            self.seq = max(self.seq + 1 if seq is None else seq, self.seq)
+            self.symbols = list(prices.keys())
+            self.index = {symbol: i for i, symbol in enumerate(self.symbols)}
+            self.prices = np.fromiter(prices.values(), dtype=np.float64, count=len(self.symbols))
+            stamps = stamps or {}
+            self.changed_seq = np.fromiter(
+                (stamps.get(symbol, self.seq) for symbol in self.symbols), dtype=np.int64, count=len(self.symbols)
+            )
+
+    def merge(self, rows):
+        """Apply (symbol, price, seq) rows written by the process that runs the tick."""
+        with self.lock:
+            prices, changed_seq = self.prices.copy(), self.changed_seq.copy()
+            added = [symbol for symbol, _, _ in rows if symbol not in self.index]
+            if added:
+                self.symbols = self.symbols + added
+                self.index = {symbol: i for i, symbol in enumerate(self.symbols)}
+                prices = np.append(prices, np.zeros(len(added)))
+                changed_seq = np.append(changed_seq, np.zeros(len(added), dtype=np.int64))
+            for symbol, price, seq in rows:
+                i = self.index[symbol]
+                prices[i] = price
+                changed_seq[i] = seq
+                self.seq = max(self.seq, seq)
+            # New arrays rather than writes in place, as in apply()
+            self.prices, self.changed_seq = prices, changed_seq
+
+    def initial_prices(self, count):
+        low, high = INITIAL_PRICE_RANGE
+        return np.round(self.rng.uniform(low, high, count), 2)
+
+    def simulate(self):
+        """Return the next random-walk step for every symbol without applying it."""
+        shocks = self.rng.uniform(-MAX_TICK_CHANGE, MAX_TICK_CHANGE, len(self.prices))
+        return np.round(np.maximum(PRICE_FLOOR, self.prices * (1.0 + shocks)), 2)
+
+    def apply(self, new_prices):
+        with self.lock:
+            self.seq += 1
+            self.changed_seq[new_prices != self.prices] = self.seq
+            self.prices = new_prices
+            return self.prices
+
+    def step(self):
+        return self.apply(self.simulate())
+
+    def as_dict(self):
+        return dict(zip(self.symbols, self.prices.tolist()))
+
+    def capture(self):
+        """Return (seq, symbols, prices, changed_seq) as of one tick; the arrays are copies the caller may keep."""
+        with self.lock:
+            return self.seq, self.symbols, self.prices.copy(), self.changed_seq.copy()
+
+price_engine = PriceTickEngine()
+
+PriceSnapshot = namedtuple('PriceSnapshot', 'seq etag payload prices symbols changed_seq')
+
+class PriceFeed:
+    """Serialized views of the latest tick, built once per tick instead of per request.
+
+    The full snapshot is encoded when the tick lands and published as one
+    immutable PriceSnapshot, so a request that reads `current` once gets a
+    seq, ETag and payload from the same tick. The snapshot also keeps a copy
+    of the tick each symbol last moved on, and delta payloads for
+    `?since=<seq>` are built from that copy, never from the live engine.
+    They are encoded on first request and shared until the next tick.
+    """
+    MAX_CACHED_DELTAS = 64
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.boot_id = secrets.token_hex(4)  # Keeps ETags from colliding across restarts
+        self.current = PriceSnapshot(0, f'{self.boot_id}-0', b'{}', {}, [], np.empty(0, dtype=np.int64))
+        self.deltas = {}
+        self.lock = Lock()
+
+    def refresh(self):
+        seq, symbols, prices, changed_seq = self.engine.capture()
+        prices = dict(zip(symbols, prices.tolist()))
+        payload = json.dumps(prices, separators=(',', ':')).encode('utf-8')
+        snapshot = PriceSnapshot(seq, f'{self.boot_id}-{seq}', payload, prices, symbols, changed_seq)
+        with self.lock:
+            self.current = snapshot
+            self.deltas = {}
+        return snapshot
+
+    def delta(self, snapshot, since):
+        """Encode the prices that moved after `since`, as of `snapshot`'s tick."""
+        with self.lock:
+            payload = self.deltas.get(since) if snapshot is self.current else None
+        if payload is not None:
+            return payload
+        moved = [snapshot.symbols[i] for i in np.flatnonzero(snapshot.changed_seq > since).tolist()]
+        payload = json.dumps(
+            {'seq': snapshot.seq, 'prices': {symbol: snapshot.prices[symbol] for symbol in moved}}, separators=(',', ':')
+        ).encode('utf-8')
+        with self.lock:
+            # Only the live snapshot's deltas are shared; the cache is cleared on every refresh
+            if snapshot is self.current and len(self.deltas) < self.MAX_CACHED_DELTAS:
+                self.deltas[since] = payload
+        return payload
+
+price_feed = PriceFeed(price_engine)
+
+def dialect_insert(model):
+    """Return an INSERT for the bound dialect that supports ON CONFLICT upserts."""
+    if db.engine.dialect.name == 'postgresql':
+        return postgresql.insert(model)
+    return sqlite.insert(model)
+
+def upsert_stock_prices(prices, seq):
+    """Write a {symbol: price} mapping, stamped with tick `seq`, as one INSERT ... ON CONFLICT executemany."""
+    if not prices:
+        return
+    stmt = dialect_insert(StockPrice.__table__)
+    stmt = stmt.on_conflict_do_update(index_elements=['symbol'], set_={'price': stmt.excluded.price, 'seq': stmt.excluded.seq})
+    db.session.execute(stmt, [{'symbol': symbol, 'price': price, 'seq': seq} for symbol, price in prices.items()])
+
+# --- Market Data Providers ---
+QUOTE_PROVIDER = os.environ.get('QUOTE_PROVIDER', 'simulator')  # 'simulator' or 'http'
+QUOTE_PROVIDER_URL = os.environ.get('QUOTE_PROVIDER_URL', 'http://127.0.0.1:5001')
+QUOTE_BATCH_SIZE = 500  # Symbols per HTTP request
+QUOTE_POOL_SIZE = 8  # Pooled keep-alive connections, also the number of batches in flight
+QUOTE_TIMEOUT = (2.0, 5.0)  # (connect, read) seconds
+
+class SimulatedQuoteProvider:
+    """The built-in random walk."""
+    name = 'simulator'
+
+    def next_prices(self, engine):
+        return engine.simulate()
+
+class HttpQuoteProvider:
+    """Fetches quotes from an HTTP endpoint in batches over a pooled session.
+
+    The endpoint is called as GET <base_url>/quotes?symbols=A,B,C and must
+    answer {"quotes": {"A": 123.45, ...}}. Batches run concurrently over
+    keep-alive connections. Any symbol that fails or is missing from the
+    response gets the fallback provider's price for this tick, and so does
+    every symbol of a batch whose response is malformed.
+    """
+    name = 'http'
+
+    def __init__(self, base_url, fallback, batch_size=QUOTE_BATCH_SIZE, pool_size=QUOTE_POOL_SIZE, timeout=QUOTE_TIMEOUT):
+        self.base_url = base_url.rstrip('/')
+        self.fallback = fallback
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=pool_size,
+            max_retries=Retry(total=1, backoff_factor=0.1, status_forcelist=(502, 503, 504))
+        )
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix='quotes')
+
+    def fetch_batch(self, symbols):
+        try:
+            response = self.session.get(
+                f'{self.base_url}/quotes', params={'symbols': ','.join(symbols)}, timeout=self.timeout
+            )
+            response.raise_for_status()
+            body = response.json()
+            quotes = body.get('quotes') if isinstance(body, dict) else None
+            if not isinstance(quotes, dict):
+                raise ValueError('response has no "quotes" object')
+            return {symbol: float(price) for symbol, price in quotes.items() if price is not None}
+        except (requests.RequestException, ValueError, TypeError) as e:
+            app.logger.warning(f'Quote batch of {len(symbols)} symbols failed: {e}')
+            return {}
+
+    def next_prices(self, engine):
+        symbols = engine.symbols
+        batches = [symbols[i:i + self.batch_size] for i in range(0, len(symbols), self.batch_size)]
+        prices = np.full(len(symbols), np.nan)
+        for quotes in self.executor.map(self.fetch_batch, batches):
+            for symbol, price in quotes.items():
+                position = engine.index.get(symbol)
+                if position is not None:
+                    prices[position] = price
+        missing = ~np.isfinite(prices) | (prices <= 0)
+        if missing.any():
+            prices[missing] = self.fallback.next_prices(engine)[missing]
+        return np.round(prices, 2)
+
+def make_quote_provider(kind=QUOTE_PROVIDER):
+    simulator = SimulatedQuoteProvider()
+    if kind == 'http':
+        return HttpQuoteProvider(QUOTE_PROVIDER_URL, fallback=simulator)
+    return simulator
+
+quote_provider = make_quote_provider()
+
+# --- Price History and Candles ---
+CANDLE_INTERVALS = {'1m': 60, '5m': 300, '1h': 3600, '1d': 86400}
+TICK_RETENTION_SECONDS = 86400  # Raw ticks are kept for a day, candles carry the rest
+CANDLE_RETENTION_SECONDS = {'1m': 7 * 86400, '5m': 30 * 86400, '1h': 365 * 86400, '1d': None}
+HISTORY_DELETE_CHUNK_SIZE = 5000
+RESET_TOKEN_TTL = timedelta(hours=1)
+RESET_TOKEN_SWEEP_SECONDS = 600
+RESET_TOKEN_SWEEP_CHUNK_SIZE = 1000
+
+def _greatest(a, b):
+    return func.greatest(a, b) if db.engine.dialect.name == 'postgresql' else func.max(a, b)
+
+def _least(a, b):
+    return func.least(a, b) if db.engine.dialect.name == 'postgresql' else func.min(a, b)
+
+def record_price_tick(prices, recorded_at=None):
+    """Append a tick to the history and fold it into every open candle.
+
+    The ticks go in as one executemany. Each candle interval is then a single
+    INSERT ... SELECT over the rows just written, so candles are maintained
+    incrementally and never rebuilt from the raw history.
+    """
+    if not prices:
+        return
+    recorded_at = int(recorded_at if recorded_at is not None else time.time())
+    ticks = PriceTick.__table__
+    candles = PriceCandle.__table__
+    last_id = db.session.execute(select(func.coalesce(func.max(ticks.c.id), 0))).scalar()
+    db.session.execute(
+        ticks.insert(),
+        [{'symbol': symbol, 'price': price, 'recorded_at': recorded_at} for symbol, price in prices.items()]
+    )
+    for interval, seconds in CANDLE_INTERVALS.items():
+        new_ticks = select(
+            ticks.c.symbol,
+            literal(interval),
+            literal(recorded_at - recorded_at % seconds),
+            ticks.c.price, ticks.c.price, ticks.c.price, ticks.c.price,
+            literal(1),
+        ).where(ticks.c.id > last_id)
+        stmt = dialect_insert(candles).from_select(
+            ['symbol', 'interval', 'bucket_start', 'open', 'high', 'low', 'close', 'tick_count'], new_ticks
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['symbol', 'interval', 'bucket_start'],
+            set_={
+                'high': _greatest(candles.c.high, stmt.excluded.high),
+                'low': _least(candles.c.low, stmt.excluded.low),
+                'close': stmt.excluded.close,
+                'tick_count': candles.c.tick_count + 1,
+            }
+        )
+        db.session.execute(stmt)
+
+def delete_in_chunks(table, condition, chunk_size=HISTORY_DELETE_CHUNK_SIZE):
+    """Delete matching rows a chunk at a time, committing between chunks.
+
+    Short transactions keep the write lock from being held across one huge
+    DELETE, so ticks and trades can interleave with a large cleanup.
+    """
+    key = table.c.id
+    deleted = 0
+    while True:
+        chunk = select(key).where(condition).limit(chunk_size)
+        result = db.session.execute(delete(table).where(key.in_(chunk)))
+        db.session.commit()
+        deleted += result.rowcount
+        if result.rowcount < chunk_size:
+            return deleted
+
+def sweep_expired_reset_tokens(now=None):
+    """Delete expired password reset tokens in short chunks (uses ix_password_reset_tokens_expires_at)."""
+    now = now or datetime.utcnow()
+    with app.app_context():
+        tokens = PasswordResetToken.__table__
+        return delete_in_chunks(tokens, tokens.c.expires_at <= now, RESET_TOKEN_SWEEP_CHUNK_SIZE)
+
+def compact_price_history(now=None):
+    """Drop raw ticks and fine-grained candles that have aged out of retention.
+
+    Candles are updated as each tick lands, so old raw ticks are already
+    represented in the rollups and can simply be deleted.
+    """
+    now = int(now if now is not None else time.time())
+    with app.app_context():
+        ticks = PriceTick.__table__
+        candles = PriceCandle.__table__
+        removed = delete_in_chunks(ticks, ticks.c.recorded_at < now - TICK_RETENTION_SECONDS)
+        for interval, retention in CANDLE_RETENTION_SECONDS.items():
+            if retention is None:
+                continue
+            removed += delete_in_chunks(
+                candles, (candles.c.interval == interval) & (candles.c.bucket_start < now - retention)
+            )
+    return removed
+
+# --- Live Price Streaming ---
+# The Server-Sent Events stream is served by a small asyncio server of its own
+# rather than by Flask, so an open dashboard costs one socket and no thread.
+# It runs in the process that fires the tick (python app.py, or run-scheduler next
+# to gunicorn) and the dashboard connects to it on PRICE_STREAM_PORT.
+STREAM_KEEPALIVE_SECONDS = 15
+STREAM_PATH = '/stream/stock_prices'
+PRICE_STREAM_HOST = os.environ.get('PRICE_STREAM_HOST', '0.0.0.0')
+PRICE_STREAM_PORT = int(os.environ.get('PRICE_STREAM_PORT', 5002))  # 0 turns the stream off; dashboards poll
+# Full URL handed to the dashboard, e.g. when a reverse proxy serves the stream on the site's own origin
+PRICE_STREAM_URL = os.environ.get('PRICE_STREAM_URL')
+STREAM_MAX_BUFFER_BYTES = 64 * 1024  # A client this far behind is cut off; its browser reconnects
+STREAM_REQUEST_TIMEOUT_SECONDS = 10
+
+class PriceStreamServer:
+    """Fans each price tick out to every Server-Sent Events client from one event loop.
+
+    A tick is serialized once into a ready-to-send event and written to every
+    open socket without waiting on any of them. A client that stops reading
+    lets its write buffer grow; past STREAM_MAX_BUFFER_BYTES it is dropped
+    instead of holding the others up, and the browser reconnects to the
+    latest tick. publish() is called from the tick thread and only hands the
+    event to the loop.
+    """
+
+    def __init__(self):
+        self.loop = None
+        self.server = None
+        self.clients = set()
+        self.event = None
+
+    def start(self, host=PRICE_STREAM_HOST, port=PRICE_STREAM_PORT):
+        """Listen in a daemon thread. Returns the bound port."""
+        self.loop = asyncio.new_event_loop()
+        self.server = self.loop.run_until_complete(asyncio.start_server(self.handle, host, port))
+        self.loop.create_task(self.keepalive())
+        Thread(target=self.loop.run_forever, name='price-stream', daemon=True).start()
+        return self.server.sockets[0].getsockname()[1]
+
+    def publish(self, seq, payload):
+        event = b'id: %d\ndata: %s\n\n' % (seq, payload)
+        self.event = event
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.broadcast, event)
+
+    def broadcast(self, event):
+        for writer in list(self.clients):
+            if writer.transport.get_write_buffer_size() > STREAM_MAX_BUFFER_BYTES:
+                self.drop(writer)
+            else:
+                writer.write(event)
+
+    def drop(self, writer):
+        self.clients.discard(writer)
+        writer.transport.abort()
+
+    async def keepalive(self):
+        while True:
+            await asyncio.sleep(STREAM_KEEPALIVE_SECONDS)
+            # Comment lines keep proxies from closing an idle connection
+            self.broadcast(b': keepalive\n\n')
+
+    async def handle(self, reader, writer):
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), STREAM_REQUEST_TIMEOUT_SECONDS)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            writer.transport.abort()
+            return
+        method, _, rest = head.partition(b' ')
+        path = rest.split(b' ', 1)[0].split(b'?', 1)[0]
+        if method != b'GET' or path != STREAM_PATH.encode():
+            writer.write(b'HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+            writer.close()
+            return
+        writer.write(
+            b'HTTP/1.1 200 OK\r\n'
+            b'Content-Type: text/event-stream\r\n'
+            b'Cache-Control: no-cache\r\n'
+            b'Access-Control-Allow-Origin: *\r\n'
+            b'X-Accel-Buffering: no\r\n'
+            b'Connection: keep-alive\r\n\r\n'
+        )
+        if self.event:
+            writer.write(self.event)
+        self.clients.add(writer)
+        try:
+            # Nothing more is expected from the client; this returns when it goes away
+            while await reader.read(1024):
+                pass
+        except ConnectionError:
+            pass
+        finally:
+            self.clients.discard(writer)
+            writer.transport.abort()
+
+price_stream = PriceStreamServer()
+
+def price_stream_url():
+    """Where the dashboard should open its EventSource, or None to poll instead."""
+    if PRICE_STREAM_URL:
+        return PRICE_STREAM_URL
+    if not PRICE_STREAM_PORT:
+        return None
+    # Same host as the page, on the stream's port (an IPv6 host keeps its brackets)
+    host = request.host if request.host.endswith(']') else request.host.rsplit(':', 1)[0]
+    return f'{request.scheme}://{host}:{PRICE_STREAM_PORT}{STREAM_PATH}'
 
 # --- Background task to simulate stock prices ---
 def fetch_and_update_stock_prices():
-    global stock_prices
     with app.app_context():
-        for symbol in STOCK_SYMBOLS:
-            stock_record = StockPrice.query.filter_by(symbol=symbol).first()
-            if stock_record:
-                current_price = stock_record.price
-                change_percent = random.uniform(-0.02, 0.02)
-                new_price = current_price * (1 + change_percent)
-                new_price = round(max(1.0, new_price), 2)
-                stock_record.price = new_price
-            else:
-                new_price = round(random.uniform(50.0, 200.0), 2)
-                new_stock_price = StockPrice(symbol=symbol, price=new_price)
-                db.session.add(new_stock_price)
-            stock_prices[symbol] = new_price
+        if not len(price_engine):
+            initialize_stock_prices()
+        price_engine.apply(quote_provider.next_prices(price_engine))
+        seq, symbols, prices, changed_seq = price_engine.capture()
+        moved = np.flatnonzero(changed_seq == seq).tolist()
+        # Only the rows that moved are rewritten, stamped with this tick for the other processes
+        upsert_stock_prices({symbols[i]: prices[i].item() for i in moved}, seq)
+        record_price_tick(price_engine.as_dict())
         db.session.commit()
+    publish_stock_prices()
+    run_conditional_orders()
     # print(f"Simulated stock prices updated: {stock_prices}")
 
-def initialize_stock_prices():
+def publish_stock_prices():
+    """Hand the engine's latest tick to this process's readers."""
     global stock_prices
+    # Swap in a fresh dict so request threads never see a half-updated tick
+    stock_prices = price_engine.as_dict()
+    snapshot = price_feed.refresh()
+    price_stream.publish(snapshot.seq, snapshot.payload)
+    if leaderboard.built_at is not None:  # Only kept up to date once something has asked for it
+        leaderboard.update(stock_prices)
+
+def initialize_stock_prices(symbols=None):
+    symbols = symbols or STOCK_SYMBOLS
+    prices = StockPrice.__table__
     with app.app_context():
-        prices_exist = StockPrice.query.first()
-        if not prices_exist:
-            for symbol in STOCK_SYMBOLS:
-                new_price = round(random.uniform(50.0, 200.0), 2)
-                new_stock_price = StockPrice(symbol=symbol, price=new_price)
-                db.session.add(new_stock_price)
+        existing = {row.symbol: row for row in db.session.execute(select(prices.c.symbol, prices.c.price, prices.c.seq))}
+        missing = [symbol for symbol in symbols if symbol not in existing]
+        if missing:
+            seq = max((row.seq for row in existing.values()), default=0) + 1
+            seeded = dict(zip(missing, price_engine.initial_prices(len(missing)).tolist()))
+            # Another worker may be seeding the same symbols; whichever commits first wins
+            stmt = dialect_insert(prices).on_conflict_do_nothing(index_elements=['symbol'])
+            db.session.execute(stmt, [{'symbol': symbol, 'price': price, 'seq': seq} for symbol, price in seeded.items()])
             db.session.commit()
-        stock_records = StockPrice.query.all()
-        stock_prices = {record.symbol: record.price for record in stock_records}
-    print(f"Stock prices initialized from DB: {stock_prices}")
+            existing = {row.symbol: row for row in db.session.execute(select(prices.c.symbol, prices.c.price, prices.c.seq))}
+        price_engine.load(
+            {symbol: existing[symbol].price for symbol in symbols},
+            seq=max(row.seq for row in existing.values()),
+            stamps={symbol: existing[symbol].seq for symbol in symbols},
+        )
+    publish_stock_prices()
+    print(f"Stock prices initialized from DB: {len(stock_prices)} symbols")
+
+def sync_stock_prices():
+    """Pull the ticks the scheduler process wrote since this process last looked.
+
+    Workers that don't run the tick call this every PRICE_SYNC_SECONDS. The
+    check is one lookup on ix_stock_prices_seq; only rows stamped after the
+    engine's seq are read, and they keep their seq, so a `?since=` delta
+    means the same thing whichever worker answers.
+    """
+    prices = StockPrice.__table__
+    with app.app_context():
+        latest = db.session.execute(select(func.max(prices.c.seq))).scalar() or 0
+        if latest <= price_engine.seq:
+            return False
+        rows = db.session.execute(
+            select(prices.c.symbol, prices.c.price, prices.c.seq).where(prices.c.seq > price_engine.seq)
+        ).all()
+    price_engine.merge([tuple(row) for row in rows])
+    publish_stock_prices()
+    return True
 
 # --- Decorators and other helper functions ---
 def login_required(f):
@@ -146,45 +967,1855 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+# --- Identity Cache ---
+IDENTITY_CACHE_SIZE = 10000
+IDENTITY_CACHE_TTL_SECONDS = 60  # Bounds staleness across worker processes
+# Endpoints that never look at g.user, so the request hook skips them (the price poll issues no SQL)
+IDENTITY_FREE_ENDPOINTS = {'static', 'get_stock_prices'}
+# JSON API requests authenticate with a bearer token instead of the session cookie
+API_PREFIX = '/api/v1'
+
+class IdentityCache:
+    """LRU of detached User rows with a TTL and a version counter per user.
+
+    Commits that change a user's password, cash or holdings bump that user's
+    version, which drops the cached row; a row read before the bump is never
+    stored under the new version.
+    """
+    def __init__(self, max_size=IDENTITY_CACHE_SIZE, ttl=IDENTITY_CACHE_TTL_SECONDS):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.versions = {}
+        self.lock = Lock()
+
+    def version(self, user_id):
+        return self.versions.get(user_id, 0)
+
+    def get(self, user_id):
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is None:
+                return None
+            user, expires_at = entry
+            if expires_at < time.monotonic():
+                del self.entries[user_id]
+                return None
+            self.entries.move_to_end(user_id)
+            return user
+
+    def put(self, user, version):
+        copy = User(id=user.id, username=user.username, password_hash=user.password_hash)
+        make_transient_to_detached(copy)
+        with self.lock:
+            if self.versions.get(user.id, 0) != version:
+                return
+            self.entries[user.id] = (copy, time.monotonic() + self.ttl)
+            self.entries.move_to_end(user.id)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def bump(self, user_ids):
+        with self.lock:
+            for user_id in user_ids:
+                self.versions[user_id] = self.versions.get(user_id, 0) + 1
+                self.entries.pop(user_id, None)
+
+identity_cache = IdentityCache()
+
+def mark_user_changed(user_id):
+    """Invalidate the user's cached identity once the current transaction commits."""
+    db.session.info.setdefault('changed_users', set()).add(user_id)
+
+@event.listens_for(db.session, 'after_commit')
+def bump_changed_users(session):
+    changed = session.info.pop('changed_users', None)
+    if changed:
+        identity_cache.bump(changed)
+        leaderboard.mark_dirty(changed)
+
+@event.listens_for(db.session, 'after_rollback')
+def forget_changed_users(session):
+    session.info.pop('changed_users', None)
+
+@app.before_request
+def resolve_exchange_account():
+    # Registered first, so it runs before anything in the request touches the database
+    if not exchange_account.resolved:
+        exchange_account.resolve()
+
 @app.before_request
 def load_logged_in_user():
+    if request.endpoint in IDENTITY_FREE_ENDPOINTS or request.path.startswith(API_PREFIX):
+        return
     user_id = session.get('user_id')
     if user_id is None:
         g.user = None
-        g.user_wallet = None
+        return
+    cached = identity_cache.get(user_id)
+    if cached is not None:
+        # Attach a copy to this request's session without a SELECT
+        g.user = db.session.merge(cached, load=False)
+        return
+    version = identity_cache.version(user_id)
+    g.user = db.session.get(User, user_id)
+    if g.user:
+        identity_cache.put(g.user, version)
     else:
-        g.user = User.query.get(user_id)
-        if g.user:
-            # Load the user's wallet, create one if it doesn't exist
-            g.user_wallet = UserWallet.query.filter_by(user_id=g.user.id).first()
-            if not g.user_wallet:
-                g.user_wallet = UserWallet(user_id=g.user.id, balance=INITIAL_BALANCE)
-                db.session.add(g.user_wallet)
+        session.clear()
+
+def get_user_wallet():
+    """The logged-in user's wallet, loaded on first use and created if it doesn't exist."""
+    if 'user_wallet' not in g:
+        wallet = UserWallet.query.filter_by(user_id=g.user.id).first()
+        if not wallet:
+            wallet = UserWallet(user_id=g.user.id, balance_cents=to_cents(INITIAL_BALANCE))
+            db.session.add(wallet)
+            post_ledger('opening_balance', [(g.user.id, INITIAL_BALANCE)])
+            db.session.commit()
+        g.user_wallet = wallet
+    return g.user_wallet
+
+class ExchangeAccount:
+    """Ids of the Global_Exchange user and wallet, resolved once per process.
+
+    Money routes only need the ids to write ledger entries, fee rows and
+    wallet updates, so nothing here holds ORM objects or opens a session.
+    """
+    def __init__(self):
+        self._user_id = None
+        self._wallet_id = None
+        self.lock = Lock()
+
+    @property
+    def user_id(self):
+        if self._user_id is None:
+            self.resolve()
+        return self._user_id
+
+    @property
+    def wallet_id(self):
+        if self._wallet_id is None:
+            self.resolve()
+        return self._wallet_id
+
+    @property
+    def resolved(self):
+        return self._user_id is not None
+
+    def resolve(self):
+        """Find or create the exchange user and wallet. Runs at startup and from migrate_database().
+
+        It uses a session of its own, so it must not run after the calling
+        request has written anything: on SQLite that request holds the write
+        lock and the INSERT here would wait on it. resolve_exchange_account()
+        makes sure a request resolves the ids before it does any work.
+        """
+        with self.lock, app.app_context():
+            if self._user_id is not None:
+                return
+            global_exchange_user = User.query.filter_by(username='Global_Exchange').first()
+            if not global_exchange_user:
+                try:
+                    global_exchange_user = User(username='Global_Exchange', password_hash='NO_LOGIN')
+                    db.session.add(global_exchange_user)
+                    db.session.commit()
+                except IntegrityError:
+                    # Another worker created it first
+                    db.session.rollback()
+                    global_exchange_user = User.query.filter_by(username='Global_Exchange').one()
+
+            exchange_wallet = UserWallet.query.filter_by(user_id=global_exchange_user.id).first()
+            if not exchange_wallet:
+                # Create a wallet for the exchange user
+                exchange_wallet = UserWallet(user_id=global_exchange_user.id, balance_cents=0)
+                db.session.add(exchange_wallet)
                 db.session.commit()
+
+            self._wallet_id = exchange_wallet.id
+            self._user_id = global_exchange_user.id
+
+exchange_account = ExchangeAccount()
+
+# --- Atomic Balance Updates ---
+# Balances and share counts are changed with guarded UPDATEs that compare and
+# write in one statement, so several workers can serve trades for the same user
+# without a check in Python going stale before the write lands.
+CONTENTION_RETRIES = 5
+CONTENTION_BACKOFF_SECONDS = 0.02
+
+class ConcurrentUpdateError(Exception):
+    """A guarded update matched no row because another request changed it first."""
+
+# Wallet amounts are integer cents, the same cents the ledger entry posted alongside
+# carries, so the wallet stays an exact cache of the account's ledger balance.
+def debit_wallet(user_id, cents, required=None):
+    """Subtract `cents` only if the balance is at least `required` cents (default `cents`). Returns success."""
+    wallets = UserWallet.__table__
+    result = db.session.execute(
+        wallets.update()
+        .where(wallets.c.user_id == user_id, wallets.c.balance_cents >= (cents if required is None else required))
+        .values(balance_cents=wallets.c.balance_cents - cents)
+    )
+    mark_user_changed(user_id)
+    return result.rowcount == 1
+
+def credit_wallet(user_id, cents):
+    wallets = UserWallet.__table__
+    db.session.execute(wallets.update().where(wallets.c.user_id == user_id).values(balance_cents=wallets.c.balance_cents + cents))
+    mark_user_changed(user_id)
+
+def debit_holding(user_id, symbol, quantity):
+    """Remove shares only if that many are held, dropping the row once it is empty. Returns success."""
+    holdings = StockHolding.__table__
+    result = db.session.execute(
+        holdings.update()
+        .where(holdings.c.user_id == user_id, holdings.c.symbol == symbol, holdings.c.quantity >= quantity)
+        .values(quantity=holdings.c.quantity - quantity)
+    )
+    if result.rowcount != 1:
+        return False
+    mark_user_changed(user_id)
+    db.session.execute(delete(holdings).where(
+        holdings.c.user_id == user_id, holdings.c.symbol == symbol, holdings.c.quantity == 0
+    ))
+    return True
+
+def credit_holding(user_id, symbol, quantity, total_cost):
+    """Add shares, averaging `total_cost` into the cost basis in the same statement."""
+    holdings = StockHolding.__table__
+    stmt = dialect_insert(holdings).values(
+        user_id=user_id, symbol=symbol, quantity=quantity, cost_basis=total_cost / quantity
+    )
+    # Both SET expressions read the pre-update row
+    db.session.execute(stmt.on_conflict_do_update(
+        index_elements=[holdings.c.user_id, holdings.c.symbol],
+        set_={
+            'cost_basis': (holdings.c.cost_basis * holdings.c.quantity + total_cost) / (holdings.c.quantity + quantity),
+            'quantity': holdings.c.quantity + quantity,
+        },
+    ))
+    mark_user_changed(user_id)
+
+def is_contention_error(error):
+    message = str(getattr(error, 'orig', error)).lower()
+    code = getattr(getattr(error, 'orig', None), 'pgcode', None)
+    return 'locked' in message or 'busy' in message or code in ('40001', '40P01')
+
+def retry_on_contention(f):
+    """Re-run a view from scratch when a guarded update or the database lock loses a race."""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        for attempt in range(CONTENTION_RETRIES):
+            try:
+                return f(*args, **kwargs)
+            except (ConcurrentUpdateError, OperationalError) as e:
+                if isinstance(e, OperationalError) and not is_contention_error(e):
+                    raise
+                db.session.rollback()
+                if attempt == CONTENTION_RETRIES - 1:
+                    raise
+                time.sleep(CONTENTION_BACKOFF_SECONDS * (2 ** attempt) * random.uniform(0.5, 1.5))
+    return decorated_function
+
+# --- Market Order Accounting ---
+MAX_BATCH_ORDERS = 100
+
+class TradeError(Exception):
+    """A trade or money movement that can't be applied; the message is safe to show to the user."""
+
+class TradeBatch:
+    """Applies market buys and sells for one user on top of a single read.
+
+    The wallet, the user's holdings and the price snapshot are loaded once.
+    Each buy()/sell() validates against the running state left by earlier
+    trades in the batch. stage() writes the result with guarded updates:
+    one for the wallet, which also checks the balance never dipped below
+    zero along the way, and one per holding change. It then adds the
+    exchange-side movement and every Transaction row in bulk. A guard that
+    misses means another request got there first, and ConcurrentUpdateError
+    tells the caller to roll back and retry. The caller commits.
+    """
+
+    def __init__(self, user, wallet, holdings=None, prices=None):
+        self.user = user
+        self.balance_cents = wallet.balance_cents
+        self.prices = prices if prices is not None else stock_prices
+        if holdings is None:
+            holdings = StockHolding.query.filter_by(user_id=user.id).all()
+        self.positions = {holding.symbol: [holding.quantity, holding.cost_basis] for holding in holdings}
+        self.cash_delta = 0
+        self.deepest_debit = 0  # Cents: how far below the read balance the running balance ever goes
+        self.holding_changes = []
+        self.exchange_delta = 0.0
+        self.transactions = []
+        self.fees = []
+        self.exchange_id = exchange_account.user_id
+        self.ledger = LedgerBatch()
+
+    def _quote(self, symbol, quantity):
+        current_price = self.prices.get(symbol)
+        if not current_price or quantity <= 0:
+            raise TradeError('Invalid stock or quantity.')
+        return current_price
+
+    @property
+    def balance(self):
+        return self.balance_cents / 100
+
+    def _move_cash(self, amount):
+        cents = to_cents(amount)
+        self.balance_cents += cents
+        self.cash_delta += cents
+        self.deepest_debit = max(self.deepest_debit, -self.cash_delta)
+
+    def buy(self, symbol, quantity):
+        current_price = self._quote(symbol, quantity)
+        total_cost = current_price * quantity
+        fee = round(total_cost * STOCK_BUY_FEE_RATE, 2)
+        total_debit = total_cost + fee
+        if self.balance_cents < to_cents(total_debit):
+            raise TradeError(f'Insufficient funds to buy {quantity} shares of {symbol} (Total cost: ${total_cost:.2f}, Fee: ${fee:.2f}).')
+
+        self._move_cash(-total_debit)
+        self.exchange_delta += fee - total_cost  # Fee stays in the central fund, the cost of the stock leaves it
+
+        position = self.positions.get(symbol)
+        if position:
+            new_quantity = position[0] + quantity
+            position[1] = ((position[1] * position[0]) + total_cost) / new_quantity
+            position[0] = new_quantity
         else:
-            session.clear()
-            g.user = None
-            g.user_wallet = None
+            self.positions[symbol] = [quantity, current_price]
+        self.holding_changes.append(('buy', symbol, quantity, total_cost))
+
+        self.ledger.add('buy', [(self.user.id, -total_debit), (self.exchange_id, fee - total_cost)], symbol, quantity)
+        self.transactions.append((self.user.id, f'Buy {quantity} shares of {symbol}', -total_cost))
+        self.fees.append((f'Fee collected from {self.user.username} for Buy {symbol}', fee))
+        return {'side': 'buy', 'symbol': symbol, 'quantity': quantity, 'price': current_price, 'amount': round(total_cost, 2), 'fee': fee}
+
+    def sell(self, symbol, quantity):
+        current_price = self._quote(symbol, quantity)
+        position = self.positions.get(symbol)
+        if not position or position[0] < quantity:
+            raise TradeError('Not enough shares to sell.')
+
+        total_sale = current_price * quantity
+        profit_loss = total_sale - position[1] * quantity
+        # Only apply a fee if the sale results in a profit
+        fee = round(total_sale * STOCK_SELL_FEE_RATE, 2) if profit_loss > 0 else 0
+        net_profit = total_sale - fee
+
+        self._move_cash(net_profit)
+        self.exchange_delta += fee - total_sale  # The central fund pays for the sale and keeps any fee
+
+        position[0] -= quantity
+        if position[0] == 0:
+            del self.positions[symbol]
+        self.holding_changes.append(('sell', symbol, quantity, 0.0))
+
+        self.ledger.add('sell', [(self.user.id, net_profit), (self.exchange_id, fee - total_sale)], symbol, quantity)
+        self.transactions.append((self.user.id, f'Sell {quantity} shares of {symbol}', net_profit))
+        if fee > 0:
+            self.fees.append((f'Fee collected from {self.user.username} for Sell {symbol}', fee))
+        return {'side': 'sell', 'symbol': symbol, 'quantity': quantity, 'price': current_price, 'amount': round(total_sale, 2), 'fee': fee, 'profit_loss': round(profit_loss, 2)}
+
+    def apply(self):
+        """Write the wallet and holding changes with guarded atomic updates."""
+        if not self.holding_changes:
+            return
+        # The wallet moves by exactly what the batch posts to the user's ledger account
+        cash = self.ledger.totals().get(self.user.id, 0)
+        if not debit_wallet(self.user.id, -cash, required=self.deepest_debit):
+            raise ConcurrentUpdateError()
+        for side, symbol, quantity, total_cost in self.holding_changes:
+            if side == 'buy':
+                credit_holding(self.user.id, symbol, quantity, total_cost)
+            elif not debit_holding(self.user.id, symbol, quantity):
+                raise ConcurrentUpdateError()
+
+    def stage(self):
+        stage_trade_batches([self])
+
+def stage_trade_batches(batches):
+    """Add the exchange-side movement and Transaction rows of several batches to the session at once."""
+    batches = [batch for batch in batches if batch.transactions]
+    if not batches:
+        return
+    for batch in batches:
+        batch.apply()
+    record_exchange_delta(sum(batch.exchange_delta for batch in batches))
+    now = datetime.utcnow()
+    rows = []
+    for batch in batches:
+        rows += [{'user_id': user_id, 'transaction_type': kind, 'amount': amount, 'timestamp': now}
+                 for user_id, kind, amount in batch.transactions]
+        rows += [{'user_id': exchange_account.user_id, 'transaction_type': kind, 'amount': fee, 'timestamp': now}
+                 for kind, fee in batch.fees]
+    db.session.flush()
+    db.session.execute(Transaction.__table__.insert(), rows)
+    ledger = LedgerBatch()
+    for batch in batches:
+        ledger.journals += batch.ledger.journals
+    ledger.flush()
+
+# --- Conditional Orders ---
+# kind -> (side, direction the price has to move through the trigger)
+CONDITIONAL_ORDER_KINDS = {
+    'stop_loss': ('sell', 'falling'),
+    'take_profit': ('sell', 'rising'),
+    'limit_buy': ('buy', 'falling'),
+}
+# Ids below the high-water mark that sync() re-checks, for inserts that committed after a later id
+TRIGGER_RESYNC_WINDOW = 1000
+TRIGGER_FULL_RESYNC_SECONDS = 3600  # Backstop: every pending id, however far below the mark
+
+class TriggerIndex:
+    """Pending conditional orders per symbol, kept in heaps keyed by trigger price.
+
+    Orders that fire when the price falls to their trigger sit in a max-heap,
+    orders that fire when it rises sit in a min-heap. A tick only pops the
+    entries whose threshold was crossed, so its cost is O(k log n) for k fired
+    orders rather than a scan of everything pending. Cancelled orders are left
+    in place and filtered out by status when they fire.
+    """
+
+    def __init__(self):
+        self.falling = {}  # symbol -> [(-trigger_price, order_id)]
+        self.rising = {}  # symbol -> [(trigger_price, order_id)]
+        self.armed = set()  # Ids currently in a heap
+        self.last_id = 0
+        self.last_full_resync = time.monotonic()  # The first sync starts from id 0 anyway
+        self.lock = Lock()
+
+    def add(self, order_id, symbol, kind, trigger_price):
+        with self.lock:
+            if order_id in self.armed:
+                return
+            self.armed.add(order_id)
+            if CONDITIONAL_ORDER_KINDS[kind][1] == 'falling':
+                heapq.heappush(self.falling.setdefault(symbol, []), (-trigger_price, order_id))
+            else:
+                heapq.heappush(self.rising.setdefault(symbol, []), (trigger_price, order_id))
+            self.last_id = max(self.last_id, order_id)
+
+    def sync(self):
+        """Pick up orders placed since the last sync, including ones written by other workers.
+
+        Ids aren't committed in order across workers on PostgreSQL, so an id
+        below the high-water mark can still show up late. Each sync therefore
+        reads the pending ids from TRIGGER_RESYNC_WINDOW below the mark
+        upwards, a range scan of ix_conditional_orders_status_id that never
+        touches older orders, and loads only the ones that aren't armed yet.
+        Once every TRIGGER_FULL_RESYNC_SECONDS the scan starts at id 0, which
+        still reads only pending rows, so an order is delayed, never skipped.
+        """
+        floor = max(0, self.last_id - TRIGGER_RESYNC_WINDOW)
+        if time.monotonic() - self.last_full_resync >= TRIGGER_FULL_RESYNC_SECONDS:
+            self.last_full_resync = time.monotonic()
+            floor = 0
+        pending = set(db.session.execute(
+            select(ConditionalOrder.id).where(ConditionalOrder.status == 'pending', ConditionalOrder.id > floor)
+        ).scalars())
+        with self.lock:
+            missing = pending - self.armed
+        if not missing:
+            return
+        for order in ConditionalOrder.query.filter(ConditionalOrder.id.in_(missing)).order_by(ConditionalOrder.id):
+            self.add(order.id, order.symbol, order.kind, order.trigger_price)
+
+    def fire(self, prices):
+        """Pop and return the ids of every order whose trigger `prices` crossed."""
+        fired = []
+        with self.lock:
+            for symbol, heap in self.falling.items():
+                price = prices.get(symbol)
+                while heap and price is not None and -heap[0][0] >= price:
+                    fired.append(heapq.heappop(heap)[1])
+            for symbol, heap in self.rising.items():
+                price = prices.get(symbol)
+                while heap and price is not None and heap[0][0] <= price:
+                    fired.append(heapq.heappop(heap)[1])
+            self.armed.difference_update(fired)
+        return fired
+
+trigger_index = TriggerIndex()
+
+def run_conditional_orders():
+    """Execute the conditional orders crossed by the latest tick in one transaction.
+
+    Users, wallets and holdings for every fired order are fetched with one
+    query each, and the trades go through TradeBatch like buy_stock/sell_stock.
+    If a guarded update loses a race the whole tick is re-read and retried;
+    orders that still can't run are re-armed for the next tick.
+    """
+    with app.app_context():
+        trigger_index.sync()
+        fired = trigger_index.fire(stock_prices)
+        if not fired:
+            return 0
+        prices = stock_prices
+        for attempt in range(CONTENTION_RETRIES):
+            try:
+                return execute_conditional_orders(fired, prices)
+            except (ConcurrentUpdateError, OperationalError) as e:
+                if isinstance(e, OperationalError) and not is_contention_error(e):
+                    raise
+                db.session.rollback()
+                time.sleep(CONTENTION_BACKOFF_SECONDS * (2 ** attempt) * random.uniform(0.5, 1.5))
+        for order in ConditionalOrder.query.filter(ConditionalOrder.id.in_(fired), ConditionalOrder.status == 'pending'):
+            trigger_index.add(order.id, order.symbol, order.kind, order.trigger_price)
+        return 0
+
+def execute_conditional_orders(order_ids, prices):
+    orders = ConditionalOrder.query.filter(
+        ConditionalOrder.id.in_(order_ids), ConditionalOrder.status == 'pending'
+    ).order_by(ConditionalOrder.id).all()
+    user_ids = {order.user_id for order in orders}
+    users = {user.id: user for user in User.query.filter(User.id.in_(user_ids))}
+    wallets = {wallet.user_id: wallet for wallet in UserWallet.query.filter(UserWallet.user_id.in_(user_ids))}
+    holdings = {}
+    for holding in StockHolding.query.filter(StockHolding.user_id.in_(user_ids)):
+        holdings.setdefault(holding.user_id, []).append(holding)
+
+    batches = {}
+    now = datetime.utcnow()
+    for order in orders:
+        if order.user_id not in users or order.user_id not in wallets:
+            order.status = 'rejected'
+            order.note = 'Account not found.'
+            continue
+        batch = batches.get(order.user_id)
+        if batch is None:
+            batch = batches[order.user_id] = TradeBatch(
+                users[order.user_id], wallets[order.user_id], holdings=holdings.get(order.user_id, []), prices=prices
+            )
+        side = CONDITIONAL_ORDER_KINDS[order.kind][0]
+        try:
+            result = batch.buy(order.symbol, order.quantity) if side == 'buy' else batch.sell(order.symbol, order.quantity)
+            order.status = 'executed'
+            order.executed_price = result['price']
+        except TradeError as e:
+            order.status = 'rejected'
+            order.note = str(e)[:200]
+        order.executed_at = now
+    stage_trade_batches(batches.values())
+    db.session.commit()
+    return len(orders)
+
+# --- Limit Order Book ---
+class RestingOrder:
+    __slots__ = ('id', 'user_id', 'side', 'price', 'remaining', 'reserved', 'cost_basis')
+
+    def __init__(self, id, user_id, side, price, remaining, reserved=0.0, cost_basis=0.0):
+        self.id = id
+        self.user_id = user_id
+        self.side = side
+        self.price = price
+        self.remaining = remaining
+        self.reserved = reserved
+        self.cost_basis = cost_basis
+
+class PriceLevel:
+    __slots__ = ('orders', 'live')
+
+    def __init__(self):
+        self.orders = deque()  # FIFO, so earlier orders at a price fill first
+        self.live = 0
+
+class OrderBook:
+    """One symbol's resting limit orders, matched by price-time priority.
+
+    Each side is a heap of prices over a dict of FIFO price levels. Adding an
+    order, finding the best bid/ask and matching are O(log n) in the number
+    of price levels. Cancelling is O(1): the order is marked dead and skipped
+    when it reaches the front of its level, and empty levels are dropped from
+    the heap the next time they surface.
+    """
+
+    def __init__(self, symbol):
+        self.symbol = symbol
+        self.heaps = {'buy': [], 'sell': []}  # Bids are stored negated so both are min-heaps
+        self.levels = {'buy': {}, 'sell': {}}
+        self.orders = {}
+        self.version = 0  # The committed order_book_versions row this book reflects
+        self.lock = Lock()
+
+    def clear(self):
+        self.heaps = {'buy': [], 'sell': []}
+        self.levels = {'buy': {}, 'sell': {}}
+        self.orders = {}
+
+    def _heap_key(self, side, price):
+        return -price if side == 'buy' else price
+
+    def best(self, side):
+        """Return the best price on `side`, or None when that side is empty."""
+        heap, levels = self.heaps[side], self.levels[side]
+        while heap:
+            price = -heap[0] if side == 'buy' else heap[0]
+            if price in levels:
+                return price
+            heapq.heappop(heap)
+        return None
+
+    def best_bid(self):
+        return self.best('buy')
+
+    def best_ask(self):
+        return self.best('sell')
+
+    def add(self, order):
+        levels = self.levels[order.side]
+        level = levels.get(order.price)
+        if level is None:
+            level = levels[order.price] = PriceLevel()
+            heapq.heappush(self.heaps[order.side], self._heap_key(order.side, order.price))
+        level.orders.append(order)
+        level.live += 1
+        self.orders[order.id] = order
+
+    def _retire(self, order):
+        level = self.levels[order.side][order.price]
+        level.live -= 1
+        if level.live == 0:
+            del self.levels[order.side][order.price]
+        del self.orders[order.id]
+
+    def cancel(self, order_id):
+        """Pull a resting order off the book and return it, or None if it isn't resting."""
+        order = self.orders.get(order_id)
+        if order is None:
+            return None
+        self._retire(order)
+        order.remaining = 0
+        return order
+
+    def match(self, incoming):
+        """Cross `incoming` against the opposite side and return [(resting, quantity, price), ...].
+
+        Fills happen at the resting order's price. Whatever is left of
+        `incoming` is not added to the book; call add() for that.
+        """
+        opposite = 'sell' if incoming.side == 'buy' else 'buy'
+        fills = []
+        while incoming.remaining > 0:
+            price = self.best(opposite)
+            if price is None or (price > incoming.price if incoming.side == 'buy' else price < incoming.price):
+                break
+            level = self.levels[opposite][price]
+            while incoming.remaining > 0 and level.live > 0:
+                resting = level.orders[0]
+                if resting.remaining == 0:
+                    level.orders.popleft()  # Cancelled earlier
+                    continue
+                quantity = min(incoming.remaining, resting.remaining)
+                fills.append((resting, quantity, price))
+                incoming.remaining -= quantity
+                resting.remaining -= quantity
+                if resting.remaining == 0:
+                    level.orders.popleft()
+                    self._retire(resting)
+        return fills
+
+    def depth(self, side, levels=10):
+        book = self.levels[side]
+        prices = heapq.nlargest(levels, book) if side == 'buy' else heapq.nsmallest(levels, book)
+        return [{'price': price, 'quantity': sum(o.remaining for o in book[price].orders)} for price in prices]
+
+order_books = {}
+order_books_lock = Lock()
+
+def get_order_book(symbol):
+    book = order_books.get(symbol)
+    if book is None:
+        with order_books_lock:
+            book = order_books.setdefault(symbol, OrderBook(symbol))
+    return book
+
+def read_order_books(symbol=None):
+    """Rebuild the in-memory books (or one symbol's) from the open orders the current session sees.
+
+    Orders go in oldest first to keep time priority. The versions are read
+    first, so a change committed in between leaves a book newer than its
+    version and costs a reload later, never a missed order.
+    """
+    versions = OrderBookVersion.__table__
+    query = select(versions.c.symbol, versions.c.version)
+    if symbol:
+        query = query.where(versions.c.symbol == symbol)
+    versions = dict(db.session.execute(query).all())
+    books = [get_order_book(symbol)] if symbol else list(order_books.values())
+    for book in books:
+        book.clear()
+    query = LimitOrder.query.filter_by(status='open')
+    if symbol:
+        query = query.filter_by(symbol=symbol)
+    for order in query.order_by(LimitOrder.id).yield_per(1000):
+        get_order_book(order.symbol).add(RestingOrder(
+            order.id, order.user_id, order.side, order.limit_price, order.remaining,
+            order.reserved, order.cost_basis
+        ))
+    for book in (books if symbol else list(order_books.values())):
+        book.version = versions.get(book.symbol, 0)
+
+def load_order_books(symbol=None):
+    with app.app_context():
+        read_order_books(symbol)
+
+def claim_order_book(book):
+    """Bump the symbol's book version in this transaction and return the new version.
+
+    Call under book.lock before changing the symbol's open orders, and set
+    book.version to the returned value once the transaction commits. Each
+    worker keeps its own books, so if the bump shows another worker changed
+    this symbol since, the book is first reloaded from the open orders this
+    transaction sees. The bumped row stays locked until commit, so workers
+    change one symbol's orders one at a time (SQLite's write lock already
+    serializes them).
+    """
+    versions = OrderBookVersion.__table__
+    stmt = dialect_insert(versions).values(symbol=book.symbol, version=1)
+    version = db.session.execute(
+        stmt.on_conflict_do_update(index_elements=['symbol'], set_={'version': versions.c.version + 1})
+        .returning(versions.c.version)
+    ).scalar()
+    if version != book.version + 1:
+        read_order_books(book.symbol)
+        book.version = version - 1
+    return version
+
+def refresh_order_book(book):
+    """Reload the book under book.lock if another worker has changed the symbol's orders since."""
+    version = db.session.execute(
+        select(OrderBookVersion.version).where(OrderBookVersion.symbol == book.symbol)
+    ).scalar() or 0
+    if version != book.version:
+        read_order_books(book.symbol)
+
+def credit_wallets(deltas):
+    """Apply {user_id: cents} to wallet balances in a single executemany."""
+    rows = [{'b_user_id': user_id, 'b_delta': delta} for user_id, delta in deltas.items() if delta]
+    if not rows:
+        return
+    wallets = UserWallet.__table__
+    db.session.flush()
+    db.session.execute(
+        wallets.update().where(wallets.c.user_id == bindparam('b_user_id'))
+        .values(balance_cents=wallets.c.balance_cents + bindparam('b_delta')),
+        rows
+    )
+    for row in rows:
+        mark_user_changed(row['b_user_id'])
+
+def settle_fills(symbol, incoming, fills):
+    """Persist one matching pass: fills, order updates, cash, shares and ledger rows, all in bulk.
+
+    Buyers pay the fill price plus the buy fee out of the cash they reserved
+    and get the unused part of the reserve back. Sellers receive the proceeds,
+    less the sell fee when the sale is at a profit, as with sell_stock.
+    """
+    if not fills:
+        return
+    now = datetime.utcnow()
+    fill_rows, transaction_rows = [], []
+    ledger = LedgerBatch()
+    traders = set()
+    bought = {}
+    fees = 0.0
+    touched = {incoming.id: incoming}
+    # Shares each order still had open before this pass, for splitting buy reserves
+    left = {incoming.id: incoming.remaining}
+    for resting, quantity, price in fills:
+        touched[resting.id] = resting
+        left[incoming.id] += quantity
+        left[resting.id] = left.get(resting.id, resting.remaining) + quantity
+    previous = dict(left)
+    for resting, quantity, price in fills:
+        buy, sell = (incoming, resting) if incoming.side == 'buy' else (resting, incoming)
+        fill_rows.append({
+            'symbol': symbol, 'price': price, 'quantity': quantity,
+            'buy_order_id': buy.id, 'sell_order_id': sell.id, 'created_at': now
+        })
+        cost = price * quantity
+        buy_fee = round(cost * STOCK_BUY_FEE_RATE, 2)
+        # Release the reserve in proportion to the shares filled; the last fill releases the rest
+        released = round(buy.reserved * quantity / left[buy.id], 2) if left[buy.id] > quantity else buy.reserved
+        buy.reserved = round(buy.reserved - released, 2)
+        left[buy.id] -= quantity
+        traders.update((buy.user_id, sell.user_id))
+        lot_quantity, lot_cost = bought.get(buy.user_id, (0, 0.0))
+        bought[buy.user_id] = (lot_quantity + quantity, lot_cost + cost)
+
+        sell_fee = round(cost * STOCK_SELL_FEE_RATE, 2) if price > sell.cost_basis else 0
+        fees += buy_fee + sell_fee
+        ledger.add('order_fill', [
+            (ORDER_ESCROW_ACCOUNT_ID, -released),
+            (buy.user_id, released - cost - buy_fee),
+            (sell.user_id, cost - sell_fee),
+            (exchange_account.user_id, buy_fee + sell_fee),
+        ], symbol, quantity)
+        transaction_rows.append({'user_id': buy.user_id, 'transaction_type': f'Buy {quantity} shares of {symbol} (order #{buy.id})', 'amount': -cost, 'timestamp': now})
+        transaction_rows.append({'user_id': sell.user_id, 'transaction_type': f'Sell {quantity} shares of {symbol} (order #{sell.id})', 'amount': cost - sell_fee, 'timestamp': now})
+    if fees > 0:
+        transaction_rows.append({'user_id': exchange_account.user_id, 'transaction_type': f'Fee collected for {symbol} order fills', 'amount': round(fees, 2), 'timestamp': now})
+        record_exchange_delta(fees)
+
+    db.session.execute(OrderFill.__table__.insert(), fill_rows)
+    db.session.execute(Transaction.__table__.insert(), transaction_rows)
+    orders = LimitOrder.__table__
+    # Guarded on the state the book matched against: another worker may have filled,
+    # cancelled or deleted a resting order since this process's book was loaded.
+    # One executemany; its rowcount is the total over every order.
+    result = db.session.execute(
+        orders.update()
+        .where(orders.c.id == bindparam('b_id'), orders.c.status == 'open', orders.c.remaining == bindparam('b_previous'))
+        .values(remaining=bindparam('b_remaining'), reserved=bindparam('b_reserved'), status=bindparam('b_status')),
+        [
+            {'b_id': order.id, 'b_previous': previous[order.id], 'b_remaining': order.remaining,
+             'b_reserved': order.reserved, 'b_status': 'open' if order.remaining else 'filled'}
+            for order in touched.values()
+        ]
+    )
+    if result.rowcount != len(touched):
+        raise ConcurrentUpdateError()
+    # Wallets move by exactly what the pass posts to each trader's ledger account
+    totals = ledger.totals()
+    credit_wallets({user_id: totals.get(user_id, 0) for user_id in traders})
+    for user_id, (quantity, total_cost) in bought.items():
+        credit_holding(user_id, symbol, quantity, total_cost)
+    ledger.flush()
+
+# --- Exchange Account Balance ---
+# Every money movement used to read-modify-write the Global_Exchange wallet row,
+# so all trades in the system queued behind that one row. Instead each movement
+# appends a delta, and a periodic job folds the deltas into the wallet.
+EXCHANGE_COMPACTION_SECONDS = 30
+
+def record_exchange_delta(amount):
+    """Append a change to the Global_Exchange balance without touching its wallet row."""
+    if amount:
+        db.session.execute(ExchangeBalanceDelta.__table__.insert(), {'amount': amount, 'created_at': datetime.utcnow()})
+
+def get_exchange_balance():
+    """Return the exact current exchange balance: the wallet plus every delta not yet folded in."""
+    wallet_balance = select(UserWallet.balance_cents / 100.0).where(UserWallet.id == exchange_account.wallet_id).scalar_subquery()
+    pending = select(func.coalesce(func.sum(ExchangeBalanceDelta.amount), 0.0)).scalar_subquery()
+    # One statement, so a compaction running in between can't be double counted
+    return db.session.execute(select(wallet_balance + pending)).scalar()
+
+def compact_exchange_balance():
+    """Fold the pending deltas into the Global_Exchange wallet in one short transaction."""
+    with app.app_context():
+        deltas = ExchangeBalanceDelta.__table__
+        # Fold exactly the rows this DELETE removed. Ids aren't committed in order on
+        # PostgreSQL, so a max(id) watermark could delete a delta it never summed.
+        amounts = db.session.execute(delete(deltas).returning(deltas.c.amount)).scalars().all()
+        if not amounts:
+            db.session.rollback()
+            return 0
+        wallets = UserWallet.__table__
+        db.session.execute(
+            wallets.update().where(wallets.c.id == exchange_account.wallet_id)
+            .values(balance_cents=wallets.c.balance_cents + to_cents(math.fsum(amounts)))
+        )
+        db.session.commit()
+        return len(amounts)
+
+# --- Double-Entry Ledger ---
+# Every money movement is a journal whose entries sum to zero, in integer cents.
+# Money entering or leaving the simulator (deposits, withdrawals, the market on
+# the other side of exchange trades) is booked against the external account,
+# and cash held back by resting buy orders sits in the escrow account.
+EXTERNAL_ACCOUNT_ID = 0
+ORDER_ESCROW_ACCOUNT_ID = -1
+SNAPSHOT_INTERVAL_SECONDS = 300
+SNAPSHOT_UPSERT_CHUNK_SIZE = 1000
+# Journals that only move money between accounts inside the simulator
+INTERNAL_ENTRY_TYPES = ('transfer', 'order_reserve', 'order_release', 'order_fill')
+# Rounding each leg to cents can leave a cent or two for the external account to absorb
+ROUNDING_RESIDUAL_CENTS = 2
+
+def to_cents(amount):
+    return int(round(amount * 100))
+
+class LedgerBatch:
+    """Collects journals and writes them with one insert for journals and one for entries."""
+
+    def __init__(self):
+        self.journals = []
+
+    def add(self, entry_type, legs, symbol=None, quantity=None):
+        """Queue a journal from (account id, dollars) legs; the external account takes the balance.
+
+        Legs naming the same account are summed, so a self-transfer or a user's
+        order filling against their own resting order nets out instead of one
+        leg overwriting the other.
+        """
+        entries = {}
+        for account_id, amount in legs:
+            cents = to_cents(amount)
+            if cents:
+                entries[account_id] = entries.get(account_id, 0) + cents
+        residual = -sum(entries.values())
+        if residual:
+            entries[EXTERNAL_ACCOUNT_ID] = entries.get(EXTERNAL_ACCOUNT_ID, 0) + residual
+        if entries:
+            self.journals.append(({'entry_type': entry_type, 'symbol': symbol, 'quantity': quantity}, entries))
+
+    def totals(self):
+        """Net cents per account over the queued journals."""
+        totals = {}
+        for _, entries in self.journals:
+            for account_id, cents in entries.items():
+                totals[account_id] = totals.get(account_id, 0) + cents
+        return totals
+
+    def flush(self):
+        if not self.journals:
+            return
+        now = datetime.utcnow()
+        journals = LedgerJournal.__table__
+        journal_ids = db.session.execute(
+            journals.insert().returning(journals.c.id, sort_by_parameter_order=True),
+            [dict(meta, created_at=now) for meta, _ in self.journals]
+        ).scalars().all()
+        db.session.execute(LedgerEntry.__table__.insert(), [
+            {'journal_id': journal_id, 'account_id': account_id, 'amount_cents': cents}
+            for journal_id, (_, entries) in zip(journal_ids, self.journals)
+            for account_id, cents in entries.items()
+        ])
+        self.journals = []
+
+def post_ledger(entry_type, legs, symbol=None, quantity=None):
+    batch = LedgerBatch()
+    batch.add(entry_type, legs, symbol, quantity)
+    batch.flush()
+
+def ledger_balances_query(account_ids=None):
+    """(account_id, cents) rows: each snapshot plus the entries not yet folded in, so O(tail).
+
+    Pass account_ids to limit the scan to those accounts; None reads every account.
+    """
+    entries = LedgerEntry.__table__
+    snapshots = select(BalanceSnapshot.account_id.label('account_id'), BalanceSnapshot.balance_cents.label('cents'))
+    tail = select(entries.c.account_id, entries.c.amount_cents).where(entries.c.snapshotted == false())
+    if account_ids is not None:
+        snapshots = snapshots.where(BalanceSnapshot.account_id.in_(account_ids))
+        tail = tail.where(entries.c.account_id.in_(account_ids))
+    # One statement, so a snapshot committing in between can't be counted twice or missed
+    parts = snapshots.union_all(tail).subquery()
+    return select(parts.c.account_id, func.sum(parts.c.cents)).group_by(parts.c.account_id)
+
+def get_ledger_balances_cents(account_ids=None):
+    """Balances of record as {account_id: cents}."""
+    return dict(db.session.execute(ledger_balances_query(account_ids)).all())
+
+def get_ledger_balance_cents(account_id):
+    return get_ledger_balances_cents([account_id]).get(account_id, 0)
+
+def take_balance_snapshots():
+    """Fold every entry no snapshot has absorbed yet into its account's snapshot.
+
+    The entries are claimed with one UPDATE ... RETURNING rather than read up
+    to a max(id) watermark: ids aren't committed in order on PostgreSQL, and an
+    entry whose transaction commits late is simply claimed by the next run.
+    """
+    with app.app_context():
+        entries = LedgerEntry.__table__
+        claimed = db.session.execute(
+            entries.update().where(entries.c.snapshotted == false()).values(snapshotted=True)
+            .returning(entries.c.id, entries.c.account_id, entries.c.amount_cents)
+        ).all()
+        if not claimed:
+            db.session.rollback()
+            return 0
+        tails, last_ids = {}, {}
+        for entry_id, account_id, cents in claimed:
+            tails[account_id] = tails.get(account_id, 0) + cents
+            last_ids[account_id] = max(last_ids.get(account_id, 0), entry_id)
+        now = datetime.utcnow()
+        snapshots = BalanceSnapshot.__table__
+        rows = [
+            {'account_id': account_id, 'balance_cents': tail, 'last_entry_id': last_ids[account_id], 'taken_at': now}
+            for account_id, tail in tails.items()
+        ]
+        for start in range(0, len(rows), SNAPSHOT_UPSERT_CHUNK_SIZE):
+            stmt = dialect_insert(snapshots).values(rows[start:start + SNAPSHOT_UPSERT_CHUNK_SIZE])
+            # Additive, so two workers snapshotting at once still end up with the right totals
+            db.session.execute(stmt.on_conflict_do_update(
+                index_elements=[snapshots.c.account_id],
+                set_={
+                    'balance_cents': snapshots.c.balance_cents + stmt.excluded.balance_cents,
+                    'last_entry_id': _greatest(snapshots.c.last_entry_id, stmt.excluded.last_entry_id),
+                    'taken_at': stmt.excluded.taken_at,
+                },
+            ))
+        db.session.commit()
+        return len(tails)
 
-def get_global_exchange_user():
-    global global_exchange_user_id
+def open_ledger():
+    """Post opening balances for wallets that predate the ledger, once, when the ledger is empty."""
     with app.app_context():
-        if global_exchange_user_id:
-            return User.query.get(global_exchange_user_id)
+        if db.session.query(LedgerEntry.id).first() is not None:
+            return
+        batch = LedgerBatch()
+        for wallet in UserWallet.query:
+            balance = wallet.balance
+            if wallet.user_id == exchange_account.user_id:
+                balance += db.session.execute(
+                    select(func.coalesce(func.sum(ExchangeBalanceDelta.amount), 0.0))
+                ).scalar()
+            batch.add('opening_balance', [(wallet.user_id, balance)])
+        escrow = db.session.execute(
+            select(func.coalesce(func.sum(LimitOrder.reserved), 0.0)).where(LimitOrder.status == 'open')
+        ).scalar()
+        batch.add('opening_balance', [(ORDER_ESCROW_ACCOUNT_ID, escrow)])
+        batch.flush()
+        db.session.commit()
 
-        global_exchange_user = User.query.filter_by(username='Global_Exchange').first()
-        if not global_exchange_user:
-            global_exchange_user = User(username='Global_Exchange', password_hash='NO_LOGIN')
-            db.session.add(global_exchange_user)
-            db.session.commit()
+def reconcile_ledger():
+    """Audit the ledger against itself and against the operational balances.
+
+    Returns a list of human-readable problems; an empty list means the books
+    balance. Everything runs as grouped SQL scans, so it stays fast over
+    millions of entries.
+    """
+    problems = []
+    entries = LedgerEntry.__table__
+    unbalanced = db.session.execute(
+        select(entries.c.journal_id, func.sum(entries.c.amount_cents))
+        .group_by(entries.c.journal_id).having(func.sum(entries.c.amount_cents) != 0)
+    ).all()
+    problems += [f'Journal {journal_id} is off by {cents} cents.' for journal_id, cents in unbalanced]
+
+    # An internal journal that needed the external account to balance lost one of its legs
+    leaked = db.session.execute(
+        select(entries.c.journal_id, LedgerJournal.entry_type, entries.c.amount_cents)
+        .join(LedgerJournal, LedgerJournal.id == entries.c.journal_id)
+        .where(
+            entries.c.account_id == EXTERNAL_ACCOUNT_ID,
+            LedgerJournal.entry_type.in_(INTERNAL_ENTRY_TYPES),
+            func.abs(entries.c.amount_cents) > ROUNDING_RESIDUAL_CENTS,
+        )
+    ).all()
+    problems += [f'Journal {journal_id} ({entry_type}) leaks {cents} cents to the external account.' for journal_id, entry_type, cents in leaked]
+
+    ledger = dict(db.session.execute(
+        select(entries.c.account_id, func.sum(entries.c.amount_cents)).group_by(entries.c.account_id)
+    ).all())
+    # The snapshot path is what balance reads use, so it has to agree with the full sum
+    recorded = get_ledger_balances_cents()
+    for account_id in sorted(set(ledger) | set(recorded)):
+        if ledger.get(account_id, 0) != recorded.get(account_id, 0):
+            problems.append(f'Account {account_id}: entries sum to {ledger.get(account_id, 0)} cents, '
+                            f'snapshot and tail say {recorded.get(account_id, 0)} cents.')
+
+    wallets = UserWallet.__table__
+    expected = dict(db.session.execute(select(wallets.c.user_id, wallets.c.balance_cents)).all())
+    expected[exchange_account.user_id] = to_cents(get_exchange_balance())
+    expected[ORDER_ESCROW_ACCOUNT_ID] = to_cents(db.session.execute(
+        select(func.coalesce(func.sum(LimitOrder.reserved), 0.0)).where(LimitOrder.status == 'open')
+    ).scalar())
+    for account_id in sorted(set(recorded) | set(expected)):
+        if account_id == EXTERNAL_ACCOUNT_ID:
+            continue
+        have, want = recorded.get(account_id, 0), expected.get(account_id, 0)
+        if have != want:
+            problems.append(f'Account {account_id}: ledger says {have} cents, balance is {want} cents.')
+    return problems
+
+@app.cli.command('migrate-db')
+def migrate_db_command():
+    """Create missing tables and apply pending schema migrations."""
+    applied = migrate_database()
+    print(f"{applied} migration(s) applied.")
+
+@app.cli.command('compute-risk')
+def compute_risk_command():
+    """Recompute every user's portfolio risk (normally run nightly by the scheduler)."""
+    compute_all_portfolio_risk()
+
+@app.cli.command('reconcile-ledger')
+def reconcile_ledger_command():
+    """Check that every journal balances and the ledger matches wallet balances."""
+    started = time.perf_counter()
+    problems = reconcile_ledger()
+    for problem in problems:
+        print(problem)
+    print(f'{len(problems)} problem(s) found in {time.perf_counter() - started:.2f}s.')
+
+# --- Process Startup ---
+# The price tick, conditional orders, maintenance jobs and live price stream run in exactly one process:
+# python app.py on its own, or `flask --app app run-scheduler` next to gunicorn workers.
+# Workers started by gunicorn or flask run never go through __main__, so each one
+# loads what it serves from the database on its first request and then follows the
+# ticks the scheduler writes to stock_prices.
+PRICE_SYNC_SECONDS = float(os.environ.get('PRICE_SYNC_SECONDS', 2))
+
+class ProcessStartup:
+    """Tracks what this process has started, so each piece starts once."""
+
+    def __init__(self):
+        self.ready = False
+        self.runs_tick = False  # Conditional orders are only armed where the tick fires them
+        self.scheduler = None
+        self.lock = Lock()
+
+    def prepare(self, serve_pages=True):
+        """Migrate, then load what the tick (and, if this process serves pages, the pages) need."""
+        with app.app_context():
+            print(f"Using {storage_profile(DATABASE_URL)} storage profile.")
+            print("Migrating database schema...")
+            migrate_database()
+            print("Database schema up to date.")
+
+            print("Initializing stock prices...")
+            initialize_stock_prices()
+            print("Stock prices initialized.")
+
+            print("Loading conditional orders...")
+            trigger_index.sync()
+            if serve_pages:
+                print("Loading open limit orders...")
+                load_order_books()
+            print("Order books ready.")
+
+            print("Ensuring Global Exchange account exists...")
+            exchange_account.resolve()
+            print("Global Exchange account ready.")
+
+            if serve_pages:
+                print("Building leaderboard...")
+                leaderboard.rebuild()
+                print("Leaderboard ready.")
+
+            print("Opening ledger...")
+            open_ledger()
+            print("Ledger ready.")
+        self.ready = True
+
+    def add_jobs(self, scheduler):
+        """Schedule the tick and the maintenance jobs; only one process may do this."""
+        scheduler.add_job(func=fetch_and_update_stock_prices, trigger='interval', seconds=60)
+        scheduler.add_job(func=compact_price_history, trigger='interval', hours=1)
+        scheduler.add_job(func=compact_exchange_balance, trigger='interval', seconds=EXCHANGE_COMPACTION_SECONDS)
+        scheduler.add_job(func=take_balance_snapshots, trigger='interval', seconds=SNAPSHOT_INTERVAL_SECONDS)
+        scheduler.add_job(func=compute_all_portfolio_risk, trigger='cron', hour=RISK_BATCH_HOUR)
+        scheduler.add_job(func=sweep_expired_reset_tokens, trigger='interval', seconds=RESET_TOKEN_SWEEP_SECONDS)
+        self.runs_tick = True
+
+    def start_price_stream(self):
+        """Serve the live price stream from the process that runs the tick."""
+        if PRICE_STREAM_PORT:
+            port = price_stream.start()
+            print(f"Live price stream on port {port}.")
+
+    def start_worker(self):
+        """Bring up a web worker that didn't go through prepare().
+
+        A process that already loaded prices itself (python app.py, the load
+        test, the benchmarks) is left alone. Otherwise the prices and order
+        books are read from the database, which the scheduler process has
+        already migrated and seeded, and a background job follows its ticks.
+        """
+        with self.lock:
+            if self.ready:
+                return
+            if not len(price_engine):
+                initialize_stock_prices()
+                load_order_books()
+                self.scheduler = BackgroundScheduler(daemon=True)
+                self.scheduler.add_job(func=sync_stock_prices, trigger='interval', seconds=PRICE_SYNC_SECONDS)
+                self.scheduler.start()
+            self.ready = True
+
+startup = ProcessStartup()
 
-            # Create a wallet for the exchange user
-            exchange_wallet = UserWallet(user_id=global_exchange_user.id, balance=0.0)
-            db.session.add(exchange_wallet)
-            db.session.commit()
+@app.before_request
+def start_worker():
+    if not startup.ready:
+        startup.start_worker()
+
+@app.cli.command('run-scheduler')
+def run_scheduler_command():
+    """Run the price tick, maintenance jobs and live price stream in the foreground, next to gunicorn or flask run workers."""
+    startup.prepare(serve_pages=False)
+    scheduler = BlockingScheduler()
+    startup.add_jobs(scheduler)
+    startup.start_price_stream()
+    print("Scheduler running.")
+    scheduler.start()
+
+# --- Transaction History ---
+# Pages are cut with a keyset on (timestamp, id) rather than OFFSET, so page 1000
+# costs the same index range scan as page 1 (ix_transactions_user_timestamp).
+HISTORY_PAGE_SIZE = 50
+MAX_HISTORY_PAGE_SIZE = 500
+EXPORT_BATCH_SIZE = 1000
+TRANSACTION_TYPE_PREFIXES = {
+    'deposit': 'Deposit',
+    'withdrawal': 'Withdrawal',
+    'buy': 'Buy ',
+    'sell': 'Sell ',
+    'transfer_in': 'Transfer In',
+    'transfer_out': 'Transfer Out',
+    'fee': 'Fee ',
+}
+
+def encode_history_cursor(timestamp, transaction_id):
+    return f'{timestamp.isoformat()}_{transaction_id}'
+
+def decode_history_cursor(cursor):
+    timestamp, _, transaction_id = cursor.rpartition('_')
+    return datetime.fromisoformat(timestamp), int(transaction_id)
+
+def parse_history_date(value):
+    return datetime.fromisoformat(value) if value else None
+
+def transaction_history_query(user_id, args):
+    """SELECT for a user's history, newest first, narrowed by the type/start/end query args.
+
+    Raises ValueError for an unknown type or a malformed date.
+    """
+    transactions = Transaction.__table__
+    stmt = select(
+        transactions.c.id, transactions.c.timestamp, transactions.c.transaction_type, transactions.c.amount
+    ).where(transactions.c.user_id == user_id)
+    kind = args.get('type')
+    if kind:
+        if kind not in TRANSACTION_TYPE_PREFIXES:
+            raise ValueError(f'Unknown type. Use one of: {", ".join(TRANSACTION_TYPE_PREFIXES)}.')
+        stmt = stmt.where(transactions.c.transaction_type.startswith(TRANSACTION_TYPE_PREFIXES[kind], autoescape=True))
+    start = parse_history_date(args.get('start'))
+    if start:
+        stmt = stmt.where(transactions.c.timestamp >= start)
+    end = parse_history_date(args.get('end'))
+    if end:
+        stmt = stmt.where(transactions.c.timestamp < end)
+    return stmt.order_by(transactions.c.timestamp.desc(), transactions.c.id.desc())
+
+def history_row(row):
+    return {'id': row.id, 'timestamp': row.timestamp.isoformat(), 'type': row.transaction_type, 'amount': round(row.amount, 2)}
+
+def history_page(user_id, args):
+    """One keyset page of a user's history. Returns (response body, status code)."""
+    limit = max(1, min(args.get('limit', HISTORY_PAGE_SIZE, type=int), MAX_HISTORY_PAGE_SIZE))
+    try:
+        stmt = transaction_history_query(user_id, args)
+        cursor = args.get('cursor')
+        if cursor:
+            transactions = Transaction.__table__
+            stmt = stmt.where(tuple_(transactions.c.timestamp, transactions.c.id) < decode_history_cursor(cursor))
+    except ValueError as e:
+        return {'error': str(e) or 'Invalid cursor or date.'}, 400
+    rows = db.session.execute(stmt.limit(limit + 1)).all()
+    next_cursor = encode_history_cursor(rows[limit - 1].timestamp, rows[limit - 1].id) if len(rows) > limit else None
+    return {'transactions': [history_row(row) for row in rows[:limit]], 'next_cursor': next_cursor}, 200
+
+def stream_history_export(engine, stmt, export_format):
+    """Yield the export a batch at a time from a server-side cursor, so memory stays flat."""
+    with engine.connect() as conn:
+        result = conn.execution_options(yield_per=EXPORT_BATCH_SIZE).execute(stmt)
+        if export_format == 'csv':
+            yield 'id,timestamp,type,amount\r\n'
+        for rows in result.partitions():
+            buffer = io.StringIO()
+            if export_format == 'csv':
+                writer = csv.writer(buffer)
+                writer.writerows((row.id, row.timestamp.isoformat(), row.transaction_type, round(row.amount, 2)) for row in rows)
+            else:
+                for row in rows:
+                    buffer.write(json.dumps(history_row(row), separators=(',', ':')) + '\n')
+            yield buffer.getvalue()
+
+# --- Portfolio Valuation ---
+PORTFOLIO_CACHE_SIZE = 10000
+PORTFOLIO_CACHE_TTL_SECONDS = 15  # Bounds staleness from trades committed by another worker
+
+class PortfolioValuations:
+    """Per-user valuations cached under (price tick, holdings version).
+
+    A new tick or a committed change to the user's holdings or cash (see
+    mark_user_changed) makes the entry miss; otherwise the dashboard, its
+    refreshes and the JSON endpoint all share one computation.
+    """
+    def __init__(self, max_size=PORTFOLIO_CACHE_SIZE, ttl=PORTFOLIO_CACHE_TTL_SECONDS):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, user_id):
+        # The tick and its prices come from one published snapshot, so the key always names the prices used
+        snapshot = price_feed.current
+        key = (snapshot.seq, identity_cache.version(user_id))
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is not None and entry[0] == key and entry[1] > time.monotonic():
+                self.entries.move_to_end(user_id)
+                return entry[2]
+        valuation = self.compute(user_id, snapshot.prices, snapshot.seq)
+        with self.lock:
+            self.entries[user_id] = (key, time.monotonic() + self.ttl, valuation)
+            self.entries.move_to_end(user_id)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return valuation
+
+    @staticmethod
+    def compute(user_id, prices, price_seq):
+        holdings = StockHolding.query.filter_by(user_id=user_id).order_by(StockHolding.symbol).all()
+        positions = []
+        for holding in holdings:
+            price = prices.get(holding.symbol, holding.cost_basis)
+            cost = holding.quantity * holding.cost_basis
+            market_value = holding.quantity * price
+            positions.append({
+                'symbol': holding.symbol,
+                'quantity': holding.quantity,
+                'cost_basis': round(holding.cost_basis, 2),
+                'price': round(price, 2),
+                'cost': round(cost, 2),
+                'market_value': round(market_value, 2),
+                'unrealized_pl': round(market_value - cost, 2),
+                'unrealized_pl_pct': round((market_value - cost) / cost * 100, 2) if cost else 0.0,
+            })
+        total_value = sum(position['market_value'] for position in positions)
+        total_cost = sum(position['cost'] for position in positions)
+        for position in positions:
+            position['allocation_pct'] = round(position['market_value'] / total_value * 100, 2) if total_value else 0.0
+        return {
+            'price_seq': price_seq,
+            'positions': positions,
+            'market_value': round(total_value, 2),
+            'cost': round(total_cost, 2),
+            'unrealized_pl': round(total_value - total_cost, 2),
+            'unrealized_pl_pct': round((total_value - total_cost) / total_cost * 100, 2) if total_cost else 0.0,
+        }
+
+portfolio_valuations = PortfolioValuations()
+
+# --- Risk Analytics ---
+# Metrics assume today's holdings were held over the whole lookback and come from
+# closing prices in the candle rollups. Everything is computed column-wise over a
+# (periods x users) matrix of portfolio values, so the nightly batch is a handful
+# of array operations per block of users rather than a loop over users and days.
+RISK_INTERVAL = '1d'
+RISK_LOOKBACK_PERIODS = 252
+RISK_RETURNS_SHOWN = 30  # Most recent period returns kept in each user's result
+TRADING_DAYS_PER_YEAR = 252
+RISK_FREE_RATE = float(os.environ.get('RISK_FREE_RATE', 0.0))  # Annual
+VAR_CONFIDENCE = 0.95
+RISK_BATCH_HOLDINGS = 20000  # Holdings valued per block in the nightly batch
+RISK_BATCH_HOUR = 2  # Local time the nightly batch runs
+
+def live_price(symbol):
+    return stock_prices.get(symbol, PRICE_FLOOR)
+
+def load_close_matrix(symbols, interval=RISK_INTERVAL, lookback=RISK_LOOKBACK_PERIODS):
+    """Closing prices as a (periods x symbols) array aligned on candle buckets.
+
+    Gaps are forward-filled; periods before a symbol's first candle and
+    symbols with no history at all take the earliest known (or live) price.
+    """
+    seconds = CANDLE_INTERVALS[interval]
+    start = (int(time.time()) // seconds - lookback) * seconds
+    candles = PriceCandle.__table__
+    rows = db.session.execute(
+        select(candles.c.symbol, candles.c.bucket_start, candles.c.close)
+        .where(candles.c.interval == interval, candles.c.bucket_start >= start)
+    ).all()
+    column = {symbol: i for i, symbol in enumerate(symbols)}
+    rows = [row for row in rows if row.symbol in column]
+    if not rows:
+        return np.array([live_price(symbol) for symbol in symbols], dtype=float)[None, :]
+    buckets, row_index = np.unique(np.fromiter((row.bucket_start for row in rows), dtype=np.int64, count=len(rows)), return_inverse=True)
+    closes = np.full((len(buckets), len(symbols)), np.nan)
+    closes[row_index, np.fromiter((column[row.symbol] for row in rows), dtype=np.int64, count=len(rows))] = \
+        np.fromiter((row.close for row in rows), dtype=float, count=len(rows))
+
+    # Forward fill: each cell takes the value at the last row index that had one
+    periods = np.arange(len(buckets))[:, None]
+    last_seen = np.maximum.accumulate(np.where(np.isnan(closes), 0, periods), axis=0)
+    closes = closes[last_seen, np.arange(len(symbols))]
+    # Leading gaps: back fill from the first value, or the live price if the column is empty
+    has_value = ~np.isnan(closes)
+    first = np.where(has_value.any(axis=0), closes[has_value.argmax(axis=0), np.arange(len(symbols))], np.nan)
+    live = np.array([live_price(symbol) for symbol in symbols], dtype=float)
+    first = np.where(np.isnan(first), live, first)
+    return np.where(np.isnan(closes), first, closes)
+
+def risk_metrics(values, periods_per_year):
+    """Column-wise risk metrics for a (periods x portfolios) array of portfolio values.
+
+    Metrics that need more history than there is come back as NaN.
+    """
+    returns = values[1:] / values[:-1] - 1
+    observations = len(returns)
+    current = values[-1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = returns.mean(axis=0) if observations else np.full(current.shape, np.nan)
+        std = returns.std(axis=0, ddof=1) if observations > 1 else np.full(current.shape, np.nan)
+        volatility = std * np.sqrt(periods_per_year)
+        annual_return = mean * periods_per_year
+        sharpe = np.where(volatility > 0, (annual_return - RISK_FREE_RATE) / volatility, np.nan)
+        tail = (1 - VAR_CONFIDENCE) * 100
+        historical = -np.percentile(returns, tail, axis=0) if observations else np.full(current.shape, np.nan)
+        parametric = -(mean + NormalDist().inv_cdf(1 - VAR_CONFIDENCE) * std)
+    return {
+        'returns': returns,
+        'annualized_return': annual_return,
+        'annualized_volatility': volatility,
+        'sharpe_ratio': sharpe,
+        'max_drawdown': (1 - values / np.maximum.accumulate(values, axis=0)).max(axis=0),
+        # One-period losses in dollars at VAR_CONFIDENCE, reported as positive numbers
+        'var_historical': np.maximum(historical, 0.0) * current,
+        'var_parametric': np.maximum(parametric, 0.0) * current,
+    }
+
+def holdings_key(positions):
+    """Fingerprint of a user's [(symbol, quantity)], so a cached result can tell the holdings changed."""
+    return hashlib.sha256(','.join(f'{symbol}:{quantity}' for symbol, quantity in sorted(positions)).encode('utf-8')).hexdigest()
+
+def _finite(value, digits=6):
+    return round(float(value), digits) if np.isfinite(value) else None
+
+def compute_portfolio_risk(positions_by_user, interval=RISK_INTERVAL):
+    """Risk results for {user_id: [(symbol, quantity)]}, keyed by user id."""
+    symbols = sorted({symbol for positions in positions_by_user.values() for symbol, _ in positions})
+    if not symbols:
+        return {}
+    closes = load_close_matrix(symbols, interval)
+    periods_per_year = TRADING_DAYS_PER_YEAR * 86400 / CANDLE_INTERVALS[interval]
+    returns = closes[1:] / closes[:-1] - 1
+    std = np.full(len(symbols), np.nan)
+    standardized = np.zeros_like(returns)
+    if len(returns) > 1:
+        std = returns.std(axis=0, ddof=1)
+        # Standardized returns: the correlation of any symbol subset is then one small matrix product.
+        # Flat series (std 0) get zero correlation with everything.
+        with np.errstate(divide='ignore', invalid='ignore'):
+            standardized = np.nan_to_num((returns - returns.mean(axis=0)) / std / np.sqrt(len(returns) - 1), nan=0.0, posinf=0.0, neginf=0.0)
+    market = {
+        'closes': closes,
+        'column': {symbol: i for i, symbol in enumerate(symbols)},
+        'symbols': symbols,
+        'standardized': standardized,
+        'symbol_volatility': std * np.sqrt(periods_per_year),
+        'periods_per_year': periods_per_year,
+        'interval': interval,
+    }
+
+    # Blocks of users with about RISK_BATCH_HOLDINGS holdings between them keep the value matrices small
+    blocks, block, block_size = [], [], 0
+    for user_id in sorted(uid for uid, positions in positions_by_user.items() if positions):
+        if block and block_size + len(positions_by_user[user_id]) > RISK_BATCH_HOLDINGS:
+            blocks.append(block)
+            block, block_size = [], 0
+        block.append(user_id)
+        block_size += len(positions_by_user[user_id])
+    if block:
+        blocks.append(block)
+
+    results = {}
+    for block in blocks:
+        results.update(risk_for_block(block, positions_by_user, market))
+    return results
+
+def risk_for_block(user_ids, positions_by_user, market):
+    """Gather the close columns for every holding in the block, scale by quantity and sum per user."""
+    counts = np.array([len(positions_by_user[user_id]) for user_id in user_ids])
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    held = [(market['column'][symbol], quantity) for user_id in user_ids for symbol, quantity in positions_by_user[user_id]]
+    columns = np.fromiter((column for column, _ in held), dtype=np.int64, count=len(held))
+    quantities = np.fromiter((quantity for _, quantity in held), dtype=float, count=len(held))
+    holding_values = market['closes'][:, columns] * quantities  # (periods x holdings)
+    values = np.add.reduceat(holding_values, starts, axis=1)  # (periods x users)
+    metrics = risk_metrics(values, market['periods_per_year'])
+
+    as_of = datetime.utcnow().date().isoformat()
+    results = {}
+    for i, user_id in enumerate(user_ids):
+        own = slice(starts[i], starts[i] + counts[i])
+        cols = columns[own]
+        standardized = market['standardized'][:, cols]
+        results[user_id] = {
+            'as_of': as_of,
+            'interval': market['interval'],
+            'observations': len(metrics['returns']),
+            'market_value': round(float(values[-1, i]), 2),
+            'annualized_return': _finite(metrics['annualized_return'][i]),
+            'annualized_volatility': _finite(metrics['annualized_volatility'][i]),
+            'sharpe_ratio': _finite(metrics['sharpe_ratio'][i], 4),
+            'max_drawdown': _finite(metrics['max_drawdown'][i]),
+            'var_confidence': VAR_CONFIDENCE,
+            'var_historical': _finite(metrics['var_historical'][i], 2),
+            'var_parametric': _finite(metrics['var_parametric'][i], 2),
+            'returns': [round(float(r), 6) for r in metrics['returns'][-RISK_RETURNS_SHOWN:, i]],
+            'symbols': [market['symbols'][c] for c in cols],
+            'weights': [round(float(w), 4) for w in holding_values[-1, own] / values[-1, i]],
+            'symbol_volatility': [_finite(v) for v in market['symbol_volatility'][cols]],
+            'correlation': np.round(standardized.T @ standardized, 4).tolist() if len(metrics['returns']) > 1 else None,
+        }
+    return results
+
+def load_positions(user_ids=None):
+    """{user_id: [(symbol, quantity)]} for the given users, or everyone."""
+    holdings = StockHolding.__table__
+    stmt = select(holdings.c.user_id, holdings.c.symbol, holdings.c.quantity).where(holdings.c.quantity > 0)
+    if user_ids is not None:
+        stmt = stmt.where(holdings.c.user_id.in_(user_ids))
+    positions = {}
+    for user_id, symbol, quantity in db.session.execute(stmt):
+        positions.setdefault(user_id, []).append((symbol, quantity))
+    return positions
+
+def store_portfolio_risk(results, positions_by_user):
+    if not results:
+        return
+    risk = PortfolioRisk.__table__
+    now = datetime.utcnow()
+    stmt = dialect_insert(risk)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[risk.c.user_id],
+        set_={'as_of': stmt.excluded.as_of, 'holdings_key': stmt.excluded.holdings_key,
+              'metrics': stmt.excluded.metrics, 'computed_at': stmt.excluded.computed_at},
+    )
+    rows = [{
+        'user_id': user_id,
+        'as_of': datetime.utcnow().date(),
+        'holdings_key': holdings_key(positions_by_user[user_id]),
+        'metrics': json.dumps(result, separators=(',', ':')),
+        'computed_at': now,
+    } for user_id, result in results.items()]
+    for start in range(0, len(rows), HISTORY_DELETE_CHUNK_SIZE):
+        db.session.execute(stmt, rows[start:start + HISTORY_DELETE_CHUNK_SIZE])
+
+def get_portfolio_risk(user_id):
+    """Today's cached result for the user, recomputed if it is missing, from another day, or the holdings changed."""
+    positions = load_positions([user_id]).get(user_id, [])
+    if not positions:
+        return None
+    cached = db.session.get(PortfolioRisk, user_id)
+    if cached and cached.as_of == datetime.utcnow().date() and cached.holdings_key == holdings_key(positions):
+        return json.loads(cached.metrics)
+    results = compute_portfolio_risk({user_id: positions})
+    store_portfolio_risk(results, {user_id: positions})
+    db.session.commit()
+    return results[user_id]
 
-        global_exchange_user_id = global_exchange_user.id
-        return global_exchange_user
+def compute_all_portfolio_risk():
+    """Nightly batch: recompute and store every user's risk result in one pass."""
+    with app.app_context():
+        started = time.perf_counter()
+        positions = load_positions()
+        positions.pop(exchange_account.user_id, None)
+        results = compute_portfolio_risk(positions)
+        store_portfolio_risk(results, positions)
+        db.session.commit()
+        print(f"Portfolio risk computed for {len(results)} users in {time.perf_counter() - started:.1f}s")
+        return len(results)
+
+# --- Leaderboard ---
+LEADERBOARD_SIZE = 10
+MAX_LEADERBOARD_SIZE = 100
+LEADERBOARD_REBUILD_SECONDS = 300  # Full reload; also picks up trades committed by other workers
+
+class Leaderboard:
+    """Account values (cash + holdings at current prices) kept up to date tick by tick.
+
+    Holdings are held as flat (user, symbol, quantity) arrays. A tick moves every
+    user's value by sum(quantity * price change) in one bincount, with no queries
+    and no per-user revaluation; the values are then sorted once so a page view
+    reads the top N directly and finds any user's rank with a binary search.
+    Users whose cash or holdings changed (see mark_user_changed) are reloaded
+    from the database before the next tick is applied.
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.dirty = set()
+        self.built_at = None
+        self.user_ids = np.empty(0, dtype=np.int64)
+        self.position = {}
+        self.usernames = {}
+        self.cash = np.empty(0)
+        self.symbol_index = {}
+        self.prices = np.empty(0)
+        self.holding_users = np.empty(0, dtype=np.int64)
+        self.holding_symbols = np.empty(0, dtype=np.int64)
+        self.holding_quantities = np.empty(0)
+        self.values = np.empty(0)
+        self.ascending = np.empty(0)
+        self.order = np.empty(0, dtype=np.int64)
+
+    def mark_dirty(self, user_ids):
+        with self.lock:
+            self.dirty.update(user_ids)
+
+    def _symbol_columns(self, symbols):
+        for symbol in symbols:
+            if symbol not in self.symbol_index:
+                self.symbol_index[symbol] = len(self.symbol_index)
+                self.prices = np.append(self.prices, live_price(symbol))
+        return np.fromiter((self.symbol_index[symbol] for symbol in symbols), dtype=np.int64, count=len(symbols))
+
+    def _load(self, user_ids=None):
+        """Cash, usernames and positions for the given users (or everyone but the exchange).
+
+        Open orders still belong to their owner: cash held back by a resting buy
+        counts as cash, and shares held back by a resting sell count as a
+        position (a user may then have two rows for a symbol; they are summed).
+        """
+        wallets, users, holdings, orders = UserWallet.__table__, User.__table__, StockHolding.__table__, LimitOrder.__table__
+        reserved = (
+            select(orders.c.user_id, func.sum(orders.c.reserved).label('reserved'))
+            .where(orders.c.status == 'open', orders.c.side == 'buy')
+            .group_by(orders.c.user_id)
+        )
+        if user_ids is not None:
+            reserved = reserved.where(orders.c.user_id.in_(user_ids))
+        reserved = reserved.subquery()
+        accounts = (
+            select(users.c.id, users.c.username, (wallets.c.balance_cents / 100.0 + func.coalesce(reserved.c.reserved, 0)).label('balance'))
+            .join(wallets, wallets.c.user_id == users.c.id)
+            .outerjoin(reserved, reserved.c.user_id == users.c.id)
+        )
+        owned = select(holdings.c.user_id, holdings.c.symbol, holdings.c.quantity).where(holdings.c.quantity > 0)
+        resting = (
+            select(orders.c.user_id, orders.c.symbol, orders.c.remaining)
+            .where(orders.c.status == 'open', orders.c.side == 'sell', orders.c.remaining > 0)
+        )
+        if user_ids is None:
+            accounts = accounts.where(users.c.id != exchange_account.user_id)
+        else:
+            accounts = accounts.where(users.c.id.in_(user_ids))
+            owned = owned.where(holdings.c.user_id.in_(user_ids))
+            resting = resting.where(orders.c.user_id.in_(user_ids))
+        return db.session.execute(accounts).all(), db.session.execute(owned.union_all(resting)).all()
+
+    def _set_holdings(self, users, symbols, quantities):
+        self.holding_users = users
+        self.holding_symbols = symbols
+        self.holding_quantities = quantities
+        self.values = self.cash + np.bincount(users, weights=quantities * self.prices[symbols], minlength=len(self.cash))
+
+    def _rank(self):
+        self.order = np.argsort(-self.values, kind='stable')
+        self.ascending = self.values[self.order[::-1]]
+
+    def rebuild(self):
+        """Reload everything. The queries run outside the lock so page views keep reading the old board."""
+        with self.lock:
+            self.dirty.clear()  # Changes committed from here on are picked up by the next update
+        with app.app_context():
+            accounts, positions = self._load()
+        # Column-wise unpacking; attribute access per row is the slow part at this size
+        ids, names, balances = zip(*accounts) if accounts else ((), (), ())
+        position = dict(zip(ids, range(len(ids))))
+        positions = [row for row in positions if row[0] in position]
+        users, symbols, quantities = zip(*positions) if positions else ((), (), ())
+        symbol_index = {symbol: i for i, symbol in enumerate(sorted(set(symbols)))}
+        holding_users = np.fromiter(map(position.__getitem__, users), dtype=np.int64, count=len(users))
+        holding_symbols = np.fromiter(map(symbol_index.__getitem__, symbols), dtype=np.int64, count=len(symbols))
+        with self.lock:
+            self.user_ids = np.array(ids, dtype=np.int64)
+            self.position = position
+            self.usernames = dict(zip(ids, names))
+            self.cash = np.array([balance or 0.0 for balance in balances], dtype=float)
+            self.symbol_index = symbol_index
+            self.prices = np.array([live_price(symbol) for symbol in symbol_index], dtype=float)
+            self._set_holdings(holding_users, holding_symbols, np.array(quantities, dtype=float))
+            self._rank()
+            self.built_at = time.monotonic()
+
+    def _refresh_dirty(self):
+        """Reload changed users and splice their holdings in. Returns False if a full rebuild is needed."""
+        dirty, self.dirty = self.dirty, set()
+        dirty.discard(exchange_account.user_id)
+        if not dirty:
+            return True
+        accounts, positions = self._load(dirty)
+        if {user_id for user_id in dirty if user_id in self.position} - {row.id for row in accounts}:
+            return False  # Someone deleted their account
+        for row in accounts:
+            if row.id not in self.position:
+                self.position[row.id] = len(self.user_ids)
+                self.user_ids = np.append(self.user_ids, row.id)
+                self.cash = np.append(self.cash, 0.0)
+            self.usernames[row.id] = row.username
+            self.cash[self.position[row.id]] = row.balance or 0.0
+        rows = np.fromiter((self.position[user_id] for user_id in dirty if user_id in self.position), dtype=np.int64)
+        keep = ~np.isin(self.holding_users, rows)
+        self._set_holdings(
+            np.concatenate((self.holding_users[keep], np.fromiter((self.position[row.user_id] for row in positions), dtype=np.int64, count=len(positions)))),
+            np.concatenate((self.holding_symbols[keep], self._symbol_columns([row.symbol for row in positions]))),
+            np.concatenate((self.holding_quantities[keep], np.fromiter((row.quantity for row in positions), dtype=float, count=len(positions)))),
+        )
+        return True
+
+    def update(self, prices):
+        """Apply a tick: reload changed users, move values by the price deltas, re-sort."""
+        if self.built_at is None or time.monotonic() - self.built_at > LEADERBOARD_REBUILD_SECONDS:
+            return self.rebuild()
+        with app.app_context(), self.lock:
+            if not self._refresh_dirty():
+                self.built_at = None
+            else:
+                symbols = list(self.symbol_index)
+                new_prices = np.fromiter((prices.get(symbol, price) for symbol, price in zip(symbols, self.prices)), dtype=float, count=len(symbols))
+                change = new_prices - self.prices
+                moved = change[self.holding_symbols] != 0
+                self.values += np.bincount(
+                    self.holding_users[moved],
+                    weights=self.holding_quantities[moved] * change[self.holding_symbols[moved]],
+                    minlength=len(self.values),
+                )
+                self.prices = new_prices
+                self._rank()
+        if self.built_at is None:
+            self.rebuild()
+
+    def top(self, limit=LEADERBOARD_SIZE):
+        with self.lock:
+            return [
+                {'rank': rank, 'username': self.usernames[int(self.user_ids[i])], 'value': round(float(self.values[i]), 2)}
+                for rank, i in enumerate(self.order[:limit], start=1)
+            ]
+
+    def rank_of(self, user_id):
+        """(rank, value, number of users) for the user, or None if they are not on the board yet."""
+        with self.lock:
+            i = self.position.get(user_id)
+            if i is None:
+                return None
+            value = self.values[i]
+            # Rank = 1 + number of users worth strictly more, found by binary search
+            rank = len(self.ascending) - int(np.searchsorted(self.ascending, value, side='right')) + 1
+            return rank, round(float(value), 2), len(self.ascending)
+
+leaderboard = Leaderboard()
+
+def get_leaderboard(user_id, limit=LEADERBOARD_SIZE):
+    if leaderboard.built_at is None:
+        leaderboard.rebuild()
+    standing = leaderboard.rank_of(user_id)
+    return {
+        'leaders': leaderboard.top(limit),
+        'you': {'rank': standing[0], 'value': standing[1], 'of': standing[2]} if standing else None,
+    }
+
+@app.errorhandler(ConcurrentUpdateError)
+def handle_concurrent_update(error):
+    db.session.rollback()
+    if request.is_json or request.path.startswith(API_PREFIX):
+        return jsonify({'error': 'Your account changed while this request was processed. Please retry.'}), 409
+    flash('Your account changed while this request was processed. Please try again.', 'error')
+    return redirect(request.referrer or url_for('banking_dashboard'))
+
+# --- Banking Operations ---
+# Shared by the HTML form handlers and the JSON API. They stage changes in the
+# session and raise TradeError on a rule violation; the caller commits.
+def parse_amount(value):
+    """A cash amount from a form field or JSON value, rounded to cents. Raises ValueError."""
+    amount = round(float(value), 2)
+    if not math.isfinite(amount):
+        raise ValueError('Amount must be a finite number.')
+    return amount
+
+def deposit_funds(user_id, amount):
+    if amount <= 0:
+        raise TradeError('Deposit amount must be positive.')
+    exchange_id = exchange_account.user_id  # Resolved before this transaction writes anything
+    # Update user's wallet
+    credit_wallet(user_id, to_cents(amount))
+
+    # Credit the Global_Exchange's balance (the central fund)
+    record_exchange_delta(amount)
+    post_ledger('deposit', [(user_id, amount), (exchange_id, amount)])
+
+    # Record a transaction for the user
+    db.session.add(Transaction(user_id=user_id, transaction_type='Deposit', amount=amount))
+
+def withdraw_funds(user_id, amount):
+    """Withdraw `amount` plus the fee; returns the fee."""
+    if amount <= 0:
+        raise TradeError('Invalid withdrawal amount.')
+    fee = round(amount * WITHDRAWAL_FEE_RATE, 2)
+    total_debit = amount + fee
+    exchange_id = exchange_account.user_id  # Resolved before this transaction writes anything
+
+    # Check and debit in one statement so concurrent withdrawals can't overdraw
+    if not debit_wallet(user_id, to_cents(total_debit)):
+        raise TradeError(f'Insufficient funds to cover withdrawal and fee (${fee:.2f}).')
+
+    # Debit the Global_Exchange's balance (central fund)
+    record_exchange_delta(-amount) # Only the withdrawal amount leaves the central fund
+    post_ledger('withdrawal', [(user_id, -total_debit), (exchange_id, -amount)])
+
+    # Record user transaction for withdrawal, and the fee collected
+    db.session.add(Transaction(user_id=user_id, transaction_type='Withdrawal', amount=-amount))
+    db.session.add(Transaction(user_id=exchange_id, transaction_type='Fee Collected', amount=fee))
+    return fee
+
+def transfer_funds(sender, recipient_username, amount):
+    recipient = User.query.filter_by(username=recipient_username).first()
+    if not recipient:
+        raise TradeError('Recipient not found.')
+    if amount <= 0:
+        raise TradeError('Invalid transfer amount or insufficient funds.')
+    if not db.session.query(UserWallet.id).filter_by(user_id=recipient.id).first():
+        raise TradeError('Recipient wallet not found. Please contact support.')
+
+    # The Global_Exchange balance is not affected since this is an internal transfer
+    if not debit_wallet(sender.id, to_cents(amount)):
+        raise TradeError('Invalid transfer amount or insufficient funds.')
+    credit_wallet(recipient.id, to_cents(amount))
+    post_ledger('transfer', [(sender.id, -amount), (recipient.id, amount)])
+
+    # Record transactions for both parties
+    db.session.add(Transaction(user_id=sender.id, transaction_type=f'Transfer Out to {recipient_username}', amount=-amount))
+    db.session.add(Transaction(user_id=recipient.id, transaction_type=f'Transfer In from {sender.username}', amount=amount))
+
+def run_batch_orders(user, payload):
+    """Execute a JSON batch of market orders. Returns (response body, status code)."""
+    orders = payload.get('orders')
+    if not isinstance(orders, list) or not orders:
+        return {'error': 'Expected a JSON body with a non-empty "orders" list.'}, 400
+    if len(orders) > MAX_BATCH_ORDERS:
+        return {'error': f'At most {MAX_BATCH_ORDERS} orders per batch.'}, 400
+    atomic = bool(payload.get('atomic', False))
+
+    # One wallet read, one holdings read and one price snapshot for the whole batch
+    trades = TradeBatch(user, get_user_wallet())
+    results = []
+    for index, order in enumerate(orders):
+        try:
+            side = order['side']
+            symbol = order['symbol']
+            quantity = int(order['quantity'])
+            if side == 'buy':
+                result = trades.buy(symbol, quantity)
+            elif side == 'sell':
+                result = trades.sell(symbol, quantity)
+            else:
+                raise TradeError('Side must be "buy" or "sell".')
+            results.append({'index': index, 'status': 'filled', **result})
+        except (TradeError, KeyError, TypeError, ValueError) as e:
+            error = str(e) if isinstance(e, TradeError) else 'Invalid order.'
+            results.append({'index': index, 'status': 'rejected', 'error': error})
+
+    if atomic and any(result['status'] == 'rejected' for result in results):
+        db.session.rollback()
+        results = [
+            result if result['status'] == 'rejected' else {'index': result['index'], 'status': 'rejected', 'error': 'Batch aborted.'}
+            for result in results
+        ]
+        return {'results': results}, 409
+
+    trades.stage()
+    db.session.commit()
+    return {'results': results, 'balance': round(trades.balance, 2)}, 200
 
 # --- Routes ---
 @app.route('/')
@@ -207,8 +2838,9 @@ def register():
             db.session.commit()
 
             # Create the wallet for the new user with initial balance
-            new_wallet = UserWallet(user_id=new_user.id, balance=INITIAL_BALANCE)
+            new_wallet = UserWallet(user_id=new_user.id, balance_cents=to_cents(INITIAL_BALANCE))
             db.session.add(new_wallet)
+            post_ledger('opening_balance', [(new_user.id, INITIAL_BALANCE)])
             db.session.commit()
 
             flash('Registration successful! Please log in.', 'success')
@@ -235,7 +2867,7 @@ def forgot_password():
         user = User.query.filter_by(username=username).first()
         if user:
             token = secrets.token_urlsafe(32)
-            expires_at = datetime.utcnow() + timedelta(hours=1)
+            expires_at = datetime.utcnow() + RESET_TOKEN_TTL
 
             PasswordResetToken.query.filter_by(user_id=user.id).delete()
 
@@ -253,20 +2885,23 @@ def forgot_password():
 
 @app.route('/reset_password/<token>', methods=['GET', 'POST'])
 def reset_password(token):
-    reset_token = PasswordResetToken.query.filter_by(token=token).first()
-
-    if not reset_token or reset_token.expires_at < datetime.utcnow():
+    # One lookup on the unique token index; expired tokens and deleted users simply don't match
+    match = db.session.execute(
+        select(PasswordResetToken, User)
+        .join(User, User.id == PasswordResetToken.user_id)
+        .where(PasswordResetToken.token == token, PasswordResetToken.expires_at > datetime.utcnow())
+    ).first()
+
+    if not match:
         flash('The password reset link is invalid or has expired.', 'error')
         return redirect(url_for('login'))
 
-    user = User.query.get(reset_token.user_id)
-    if not user:
-        flash('User not found.', 'error')
-        return redirect(url_for('login'))
+    reset_token, user = match
 
     if request.method == 'POST':
         new_password = request.form['new_password']
         user.set_password(new_password)
+        mark_user_changed(user.id)
 
         db.session.delete(reset_token)
         db.session.commit()
@@ -285,6 +2920,8 @@ def change_password():
     confirm_new_password = request.form.get('confirm_new_password')
 
     user = g.user
+    # Check against the stored hash, not the cached copy another worker may have changed
+    db.session.refresh(user)
 
     if not user.check_password(old_password):
         flash('Incorrect old password.', 'error')
@@ -295,6 +2932,7 @@ def change_password():
         return redirect(url_for('banking_dashboard'))
 
     user.set_password(new_password)
+    mark_user_changed(user.id)
     db.session.commit()
 
     flash('Your password has been changed successfully.', 'success')
@@ -311,85 +2949,47 @@ def logout():
 @login_required
 def banking_dashboard():
     user = g.user
-    transactions = Transaction.query.filter_by(user_id=user.id).order_by(Transaction.timestamp.desc()).limit(10).all()
-    return render_template('banking_dashboard.html', user=user, user_wallet=g.user_wallet, transactions=transactions)
+    transactions = Transaction.query.filter_by(user_id=user.id) \
+        .order_by(Transaction.timestamp.desc(), Transaction.id.desc()).limit(10).all()
+    # Where "Show more" picks up, via the /transactions API
+    history_cursor = encode_history_cursor(transactions[-1].timestamp, transactions[-1].id) if len(transactions) == 10 else None
+    return render_template('banking_dashboard.html', user=user, user_wallet=get_user_wallet(), transactions=transactions, history_cursor=history_cursor)
 
 @app.route('/deposit', methods=['POST'])
 @login_required
+@retry_on_contention
 def deposit():
     try:
-        amount = float(request.form['amount'])
+        amount = parse_amount(request.form['amount'])
     except (ValueError, KeyError):
         flash('Invalid amount.', 'error')
         return redirect(url_for('banking_dashboard'))
 
-    if amount <= 0:
-        flash('Deposit amount must be positive.', 'error')
-    else:
-        # Update user's wallet
-        g.user_wallet.balance += amount
-
-        # Update the Global_Exchange's wallet (the central fund)
-        exchange_user = get_global_exchange_user()
-        exchange_wallet = UserWallet.query.filter_by(user_id=exchange_user.id).first()
-        exchange_wallet.balance += amount
-
-        # Record a transaction for the user
-        new_transaction = Transaction(
-            user_id=g.user.id,
-            transaction_type='Deposit',
-            amount=amount
-        )
-        db.session.add(new_transaction)
-        db.session.commit()
-        flash(f'Successfully deposited ${amount:.2f}.', 'success')
+    try:
+        deposit_funds(g.user.id, amount)
+    except TradeError as e:
+        flash(str(e), 'error')
+        return redirect(url_for('banking_dashboard'))
+    db.session.commit()
+    flash(f'Successfully deposited ${amount:.2f}.', 'success')
 
     return redirect(url_for('banking_dashboard'))
 
 @app.route('/withdraw', methods=['POST'])
 @login_required
+@retry_on_contention
 def withdraw():
     try:
-        amount = float(request.form['amount'])
+        amount = parse_amount(request.form['amount'])
     except (ValueError, KeyError):
         flash('Invalid amount.', 'error')
         return redirect(url_for('banking_dashboard'))
 
-    if amount <= 0:
-        flash('Invalid withdrawal amount.', 'error')
-        return redirect(url_for('banking_dashboard'))
-
-    fee = round(amount * WITHDRAWAL_FEE_RATE, 2)
-    total_debit = amount + fee
-
-    if g.user_wallet.balance < total_debit:
-        flash(f'Insufficient funds to cover withdrawal and fee (${fee:.2f}).', 'error')
+    try:
+        fee = withdraw_funds(g.user.id, amount)
+    except TradeError as e:
+        flash(str(e), 'error')
         return redirect(url_for('banking_dashboard'))
-
-    # Update user's wallet
-    g.user_wallet.balance -= total_debit
-
-    # Update the Global_Exchange's wallet (central fund)
-    exchange_user = get_global_exchange_user()
-    exchange_wallet = UserWallet.query.filter_by(user_id=exchange_user.id).first()
-    exchange_wallet.balance -= amount # Only the withdrawal amount leaves the central fund
-
-    # Record user transaction for withdrawal
-    user_transaction = Transaction(
-        user_id=g.user.id,
-        transaction_type='Withdrawal',
-        amount=-amount
-    )
-    db.session.add(user_transaction)
-
-    # Record transaction for the fee collected
-    fee_transaction = Transaction(
-        user_id=exchange_user.id,
-        transaction_type='Fee Collected',
-        amount=fee
-    )
-    db.session.add(fee_transaction)
-
     db.session.commit()
     flash(f'Successfully withdrew ${amount:.2f} (Fee: ${fee:.2f}).', 'success')
 
@@ -397,46 +2997,22 @@ def withdraw():
 
 @app.route('/transfer', methods=['POST'])
 @login_required
+@retry_on_contention
 def transfer():
     try:
-        amount = float(request.form['amount'])
+        amount = parse_amount(request.form['amount'])
         recipient_username = request.form['recipient']
     except (ValueError, KeyError):
         flash('Invalid amount or recipient.', 'error')
         return redirect(url_for('banking_dashboard'))
 
-    recipient = User.query.filter_by(username=recipient_username).first()
-
-    if not recipient:
-        flash('Recipient not found.', 'error')
-    elif amount <= 0 or g.user_wallet.balance < amount:
-        flash('Invalid transfer amount or insufficient funds.', 'error')
-    else:
-        recipient_wallet = UserWallet.query.filter_by(user_id=recipient.id).first()
-        if not recipient_wallet:
-            flash('Recipient wallet not found. Please contact support.', 'error')
-            return redirect(url_for('banking_dashboard'))
-
-        # The Global_Exchange balance is not affected since this is an internal transfer
-        g.user_wallet.balance -= amount
-        recipient_wallet.balance += amount
-
-        # Record transactions for both parties
-        sender_transaction = Transaction(
-            user_id=g.user.id,
-            transaction_type=f'Transfer Out to {recipient_username}',
-            amount=-amount
-        )
-        recipient_transaction = Transaction(
-            user_id=recipient.id,
-            transaction_type=f'Transfer In from {g.user.username}',
-            amount=amount
-        )
-        db.session.add(sender_transaction)
-        db.session.add(recipient_transaction)
-
-        db.session.commit()
-        flash(f'Successfully transferred ${amount:.2f} to {recipient_username}.', 'success')
+    try:
+        transfer_funds(g.user, recipient_username, amount)
+    except TradeError as e:
+        flash(str(e), 'error')
+        return redirect(url_for('banking_dashboard'))
+    db.session.commit()
+    flash(f'Successfully transferred ${amount:.2f} to {recipient_username}.', 'success')
 
     return redirect(url_for('banking_dashboard'))
 
@@ -444,11 +3020,14 @@ def transfer():
 @login_required
 def stock_dashboard():
     user = g.user
-    portfolio = StockHolding.query.filter_by(user_id=user.id).all()
-    return render_template('stock_dashboard.html', user=user, user_wallet=g.user_wallet, market_prices=stock_prices, portfolio=portfolio, stock_names=STOCK_NAMES)
+    valuation = portfolio_valuations.get(user.id)
+    open_orders = LimitOrder.query.filter_by(user_id=user.id, status='open').order_by(LimitOrder.id.desc()).all()
+    conditional_orders = ConditionalOrder.query.filter_by(user_id=user.id, status='pending').order_by(ConditionalOrder.id.desc()).all()
+    return render_template('stock_dashboard.html', user=user, user_wallet=get_user_wallet(), market_prices=stock_prices, valuation=valuation, standings=get_leaderboard(user.id), stock_names=STOCK_NAMES, open_orders=open_orders, conditional_orders=conditional_orders, price_stream_url=price_stream_url())
 
 @app.route('/buy_stock', methods=['POST'])
 @login_required
+@retry_on_contention
 def buy_stock():
     try:
         symbol = request.form['symbol']
@@ -457,52 +3036,21 @@ def buy_stock():
         flash('Invalid stock or quantity.', 'error')
         return redirect(url_for('stock_dashboard'))
 
-    current_price = stock_prices.get(symbol)
-    if not current_price or quantity <= 0:
-        flash('Invalid stock or quantity.', 'error')
+    trades = TradeBatch(g.user, get_user_wallet())
+    try:
+        result = trades.buy(symbol, quantity)
+    except TradeError as e:
+        flash(str(e), 'error')
         return redirect(url_for('stock_dashboard'))
-
-    total_cost = current_price * quantity
-    fee = round(total_cost * STOCK_BUY_FEE_RATE, 2)
-    total_debit = total_cost + fee
-
-    if g.user_wallet.balance < total_debit:
-        flash(f'Insufficient funds to buy {quantity} shares of {symbol} (Total cost: ${total_cost:.2f}, Fee: ${fee:.2f}).', 'error')
-    else:
-        # Update user's wallet
-        g.user_wallet.balance -= total_debit
-
-        # Update Global_Exchange's wallet
-        exchange_user = get_global_exchange_user()
-        exchange_wallet = UserWallet.query.filter_by(user_id=exchange_user.id).first()
-        exchange_wallet.balance += fee # Fee stays in the central fund
-        exchange_wallet.balance -= total_cost # Cost of stock leaves the central fund
-
-        holding = StockHolding.query.filter_by(user_id=g.user.id, symbol=symbol).first()
-        if holding:
-            new_quantity = holding.quantity + quantity
-            new_cost_basis = ((holding.cost_basis * holding.quantity) + total_cost) / new_quantity
-            holding.quantity = new_quantity
-            holding.cost_basis = new_cost_basis
-        else:
-            new_holding = StockHolding(user_id=g.user.id, symbol=symbol, quantity=quantity, cost_basis=current_price)
-            db.session.add(new_holding)
-
-        # Record user transaction
-        new_transaction = Transaction(user_id=g.user.id, transaction_type=f'Buy {quantity} shares of {symbol}', amount=-total_cost)
-        db.session.add(new_transaction)
-
-        # Record fee transaction
-        fee_transaction = Transaction(user_id=exchange_user.id, transaction_type=f'Fee collected from {g.user.username} for Buy {symbol}', amount=fee)
-        db.session.add(fee_transaction)
-
-        db.session.commit()
-        flash(f'Successfully bought {quantity} shares of {symbol} for ${total_cost:.2f} (Fee: ${fee:.2f}).', 'success')
+    trades.stage()
+    db.session.commit()
+    flash(f'Successfully bought {quantity} shares of {symbol} for ${result["amount"]:.2f} (Fee: ${result["fee"]:.2f}).', 'success')
 
     return redirect(url_for('stock_dashboard'))
 
 @app.route('/sell_stock', methods=['POST'])
 @login_required
+@retry_on_contention
 def sell_stock():
     try:
         symbol = request.form['symbol']
@@ -511,65 +3059,262 @@ def sell_stock():
         flash('Invalid stock or quantity.', 'error')
         return redirect(url_for('stock_dashboard'))
 
-    current_price = stock_prices.get(symbol)
-    if not current_price or quantity <= 0:
-        flash('Invalid stock or quantity.', 'error')
+    trades = TradeBatch(g.user, get_user_wallet())
+    try:
+        result = trades.sell(symbol, quantity)
+    except TradeError as e:
+        flash(str(e), 'error')
         return redirect(url_for('stock_dashboard'))
+    trades.stage()
+    db.session.commit()
 
-    holding = StockHolding.query.filter_by(user_id=g.user.id, symbol=symbol).first()
-    if not holding or holding.quantity < quantity:
-        flash('Not enough shares to sell.', 'error')
-        return redirect(url_for('stock_dashboard'))
+    fee, profit_loss = result['fee'], result['profit_loss']
+    if fee > 0:
+        flash(f'Successfully sold {quantity} shares of {symbol} for a profit of ${profit_loss:.2f} (Fee: ${fee:.2f}, Net: ${result["amount"] - fee:.2f}).', 'success')
+    else:
+        flash(f'Successfully sold {quantity} shares of {symbol} for a loss of ${abs(profit_loss):.2f}. No fee was charged.', 'success')
 
-    total_sale = current_price * quantity
-    cost_of_sold_shares = holding.cost_basis * quantity
+    return redirect(url_for('stock_dashboard'))
 
-    # Calculate profit or loss
-    profit_loss = total_sale - cost_of_sold_shares
+@app.route('/batch_orders', methods=['POST'])
+@login_required
+@retry_on_contention
+def batch_orders():
+    body, status = run_batch_orders(g.user, request.get_json(silent=True) or {})
+    return jsonify(body), status
 
-    fee = 0
-    if profit_loss > 0:
-        # Only apply a fee if the sale results in a profit
-        fee = round(total_sale * STOCK_SELL_FEE_RATE, 2)
+@app.route('/place_order', methods=['POST'])
+@login_required
+@retry_on_contention
+def place_order():
+    try:
+        symbol = request.form['symbol']
+        side = request.form['side']
+        quantity = int(request.form['quantity'])
+        limit_price = round(float(request.form['limit_price']), 2)
+    except (ValueError, KeyError):
+        flash('Invalid order.', 'error')
+        return redirect(url_for('stock_dashboard'))
+
+    if symbol not in stock_prices or side not in ('buy', 'sell') or quantity <= 0 or limit_price <= 0:
+        flash('Invalid order.', 'error')
+        return redirect(url_for('stock_dashboard'))
 
-    net_profit = total_sale - fee
+    book = get_order_book(symbol)
+    with book.lock:
+        version = claim_order_book(book)
+        order = LimitOrder(user_id=g.user.id, symbol=symbol, side=side, limit_price=limit_price,
+                           quantity=quantity, remaining=quantity)
+        if side == 'buy':
+            # Hold back enough cash to fill the whole order at the limit, fee included
+            reserve = round(limit_price * quantity * (1 + STOCK_BUY_FEE_RATE), 2)
+            if not debit_wallet(g.user.id, to_cents(reserve)):
+                flash(f'Insufficient funds to reserve ${reserve:.2f} for this order.', 'error')
+                return redirect(url_for('stock_dashboard'))
+            order.reserved = reserve
+            post_ledger('order_reserve', [(g.user.id, -reserve), (ORDER_ESCROW_ACCOUNT_ID, reserve)], symbol, quantity)
+        else:
+            # Hold back the shares so they can't be sold twice
+            holding = StockHolding.query.filter_by(user_id=g.user.id, symbol=symbol).first()
+            if not holding or not debit_holding(g.user.id, symbol, quantity):
+                flash('Not enough shares to sell.', 'error')
+                return redirect(url_for('stock_dashboard'))
+            order.cost_basis = holding.cost_basis
+        db.session.add(order)
+        db.session.flush()
+
+        incoming = RestingOrder(order.id, order.user_id, side, limit_price, quantity, order.reserved, order.cost_basis)
+        fills = book.match(incoming)
+        try:
+            settle_fills(symbol, incoming, fills)
+            db.session.commit()
+        except Exception:
+            # The book already moved; put it back in line with what the database kept
+            db.session.rollback()
+            load_order_books(symbol)
+            raise
+        book.version = version
+        if incoming.remaining:
+            book.add(incoming)
+
+    filled = quantity - incoming.remaining
+    if filled:
+        flash(f'Order #{order.id}: filled {filled} of {quantity} shares of {symbol}.', 'success')
+    else:
+        flash(f'Order #{order.id} to {side} {quantity} shares of {symbol} at ${limit_price:.2f} is on the book.', 'success')
+    return redirect(url_for('stock_dashboard'))
 
-    # Update user wallet
-    g.user_wallet.balance += net_profit
+@app.route('/cancel_order/<int:order_id>', methods=['POST'])
+@login_required
+@retry_on_contention
+def cancel_order(order_id):
+    order = LimitOrder.query.filter_by(id=order_id, user_id=g.user.id, status='open').first()
+    if not order:
+        flash('Order not found.', 'error')
+        return redirect(url_for('stock_dashboard'))
 
-    # Update Global_Exchange's wallet
-    exchange_user = get_global_exchange_user()
-    exchange_wallet = UserWallet.query.filter_by(user_id=exchange_user.id).first()
-    exchange_wallet.balance -= total_sale # The central fund needs to provide the user with the money for the sale
-    if fee > 0:
-        exchange_wallet.balance += fee # If there's a fee, it's revenue for the firm, so it stays.
+    book = get_order_book(order.symbol)
+    with book.lock:
+        # Fills are committed under this lock, so the refreshed row matches the book
+        db.session.refresh(order)
+        if order.status != 'open':
+            flash('Order is no longer open.', 'error')
+            return redirect(url_for('stock_dashboard'))
+        symbol, side, remaining, reserved = order.symbol, order.side, order.remaining, order.reserved
+        orders = LimitOrder.__table__
+        try:
+            # Other workers see the bumped version and drop the order from their books
+            version = claim_order_book(book)
+            book.cancel(order.id)
+            result = db.session.execute(
+                orders.update()
+                .where(orders.c.id == order.id, orders.c.status == 'open', orders.c.remaining == remaining)
+                .values(status='cancelled', reserved=0.0)
+            )
+            if result.rowcount != 1:
+                raise ConcurrentUpdateError()
+            if side == 'buy':
+                # The reserve was a hold, never a transaction, so releasing it isn't one either
+                credit_wallet(g.user.id, to_cents(reserved))
+                post_ledger('order_release', [(ORDER_ESCROW_ACCOUNT_ID, -reserved), (g.user.id, reserved)], symbol, remaining)
+            else:
+                credit_holding(g.user.id, symbol, remaining, remaining * order.cost_basis)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            load_order_books(symbol)
+            raise
+        book.version = version
 
-    # Update stock holding
-    holding.quantity -= quantity
-    if holding.quantity == 0:
-        db.session.delete(holding)
+    flash(f'Order #{order_id} cancelled.', 'success')
+    return redirect(url_for('stock_dashboard'))
 
-    # Record user transaction
-    new_transaction = Transaction(user_id=g.user.id, transaction_type=f'Sell {quantity} shares of {symbol}', amount=net_profit)
-    db.session.add(new_transaction)
+@app.route('/place_conditional_order', methods=['POST'])
+@login_required
+def place_conditional_order():
+    try:
+        symbol = request.form['symbol']
+        kind = request.form['kind']
+        quantity = int(request.form['quantity'])
+        trigger_price = round(float(request.form['trigger_price']), 2)
+    except (ValueError, KeyError):
+        flash('Invalid order.', 'error')
+        return redirect(url_for('stock_dashboard'))
 
-    # Record fee transaction if a fee was applied
-    if fee > 0:
-        fee_transaction = Transaction(user_id=exchange_user.id, transaction_type=f'Fee collected from {g.user.username} for Sell {symbol}', amount=fee)
-        db.session.add(fee_transaction)
+    if symbol not in stock_prices or kind not in CONDITIONAL_ORDER_KINDS or quantity <= 0 or trigger_price <= 0:
+        flash('Invalid order.', 'error')
+        return redirect(url_for('stock_dashboard'))
 
+    order = ConditionalOrder(user_id=g.user.id, symbol=symbol, kind=kind, trigger_price=trigger_price, quantity=quantity)
+    db.session.add(order)
     db.session.commit()
+    if startup.runs_tick:
+        trigger_index.add(order.id, symbol, kind, trigger_price)
 
-    if fee > 0:
-        flash(f'Successfully sold {quantity} shares of {symbol} for a profit of ${profit_loss:.2f} (Fee: ${fee:.2f}, Net: ${net_profit:.2f}).', 'success')
-    else:
-        flash(f'Successfully sold {quantity} shares of {symbol} for a loss of ${abs(profit_loss):.2f}. No fee was charged.', 'success')
+    flash(f'{kind.replace("_", " ").title()} order #{order.id} for {quantity} shares of {symbol} at ${trigger_price:.2f} is armed.', 'success')
+    return redirect(url_for('stock_dashboard'))
 
+@app.route('/cancel_conditional_order/<int:order_id>', methods=['POST'])
+@login_required
+def cancel_conditional_order(order_id):
+    order = ConditionalOrder.query.filter_by(id=order_id, user_id=g.user.id, status='pending').first()
+    if not order:
+        flash('Order not found.', 'error')
+        return redirect(url_for('stock_dashboard'))
+    order.status = 'cancelled'
+    db.session.commit()
+    flash(f'Order #{order.id} cancelled.', 'success')
     return redirect(url_for('stock_dashboard'))
 
+@app.route('/order_book/<symbol>')
+def order_book(symbol):
+    book = get_order_book(symbol)
+    with book.lock:
+        refresh_order_book(book)
+        return jsonify({
+            'symbol': symbol,
+            'best_bid': book.best_bid(),
+            'best_ask': book.best_ask(),
+            'bids': book.depth('buy'),
+            'asks': book.depth('sell'),
+        })
+
 @app.route('/get_stock_prices')
 def get_stock_prices():
-    return jsonify(stock_prices)
+    snapshot = price_feed.current  # Read once: a tick may land while this request runs
+    since = request.args.get('since', type=int)
+    if since is not None:
+        # A cursor from the future (e.g. from before a restart) gets everything
+        since = since if 0 <= since <= snapshot.seq else 0
+        payload = price_feed.delta(snapshot, since)
+    else:
+        payload = snapshot.payload
+    response = Response(payload, mimetype='application/json')
+    response.set_etag(f'{snapshot.etag}-{since}' if since is not None else snapshot.etag)
+    response.headers['X-Price-Seq'] = str(snapshot.seq)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
+@app.route('/price_history/<symbol>')
+def price_history(symbol):
+    interval = request.args.get('interval', '1m')
+    if interval not in CANDLE_INTERVALS:
+        return jsonify({'error': f'Unknown interval. Use one of: {", ".join(CANDLE_INTERVALS)}.'}), 400
+    limit = min(request.args.get('limit', 200, type=int), 1000)
+    candles = PriceCandle.query.filter_by(symbol=symbol, interval=interval) \
+        .order_by(PriceCandle.bucket_start.desc()).limit(limit).all()
+    return jsonify([
+        {'t': c.bucket_start, 'o': c.open, 'h': c.high, 'l': c.low, 'c': c.close, 'n': c.tick_count}
+        for c in reversed(candles)
+    ])
+
+@app.route('/transactions')
+@login_required
+def transaction_history():
+    body, status = history_page(g.user.id, request.args)
+    return jsonify(body), status
+
+@app.route('/transactions/export')
+@login_required
+def export_transactions():
+    export_format = request.args.get('format', 'csv')
+    if export_format not in ('csv', 'ndjson'):
+        return jsonify({'error': 'Format must be "csv" or "ndjson".'}), 400
+    try:
+        stmt = transaction_history_query(g.user.id, request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    mimetype = 'text/csv' if export_format == 'csv' else 'application/x-ndjson'
+    filename = f'transactions.{export_format}'
+    return Response(
+        stream_history_export(db.engine, stmt, export_format),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename={filename}', 'X-Accel-Buffering': 'no'}
+    )
+
+@app.route('/portfolio_valuation')
+@login_required
+def portfolio_valuation():
+    return jsonify(portfolio_valuations.get(g.user.id))
+
+@app.route('/portfolio_risk')
+@login_required
+def portfolio_risk():
+    result = get_portfolio_risk(g.user.id)
+    if result is None:
+        return jsonify({'error': 'Your portfolio is empty.'}), 404
+    return jsonify(result)
+
+@app.route('/leaderboard')
+@login_required
+def leaderboard_view():
+    limit = max(1, min(request.args.get('limit', LEADERBOARD_SIZE, type=int), MAX_LEADERBOARD_SIZE))
+    return jsonify(get_leaderboard(g.user.id, limit))
+
+@app.route('/exchange_balance')
+@login_required
+def exchange_balance():
+    return jsonify({'balance': round(get_exchange_balance(), 2)})
 
 @app.route('/confirm_delete')
 @login_required
@@ -578,42 +3323,227 @@ def confirm_delete():
 
 @app.route('/delete_account', methods=['POST'])
 @login_required
+@retry_on_contention
 def delete_account():
     user = g.user
     user_id = user.id
 
     # Delete all associated records
     StockHolding.query.filter_by(user_id=user_id).delete()
+    orders = LimitOrder.__table__
+    own_orders = select(orders.c.id).where(orders.c.user_id == user_id)
+    # A fill is the counterparty's history too: keep it and only drop the reference to
+    # this user's order, which has to go before the orders, which go before the user
+    fills = OrderFill.__table__
+    db.session.execute(fills.update().where(fills.c.buy_order_id.in_(own_orders)).values(buy_order_id=None))
+    db.session.execute(fills.update().where(fills.c.sell_order_id.in_(own_orders)).values(sell_order_id=None))
+    # Sum what was actually deleted, so a fill committed by another worker in the meantime is respected
+    deleted_orders = db.session.execute(
+        delete(orders).where(orders.c.user_id == user_id).returning(orders.c.id, orders.c.symbol, orders.c.status, orders.c.reserved)
+    ).all()
+    forfeited = math.fsum(order.reserved for order in deleted_orders if order.status == 'open')
+    # Tell every worker's books these orders are gone
+    versions = OrderBookVersion.__table__
+    symbols = sorted({order.symbol for order in deleted_orders if order.status == 'open'})
+    bumped = []
+    if symbols:
+        stmt = dialect_insert(versions).values([{'symbol': symbol, 'version': 1} for symbol in symbols])
+        bumped = db.session.execute(
+            stmt.on_conflict_do_update(index_elements=['symbol'], set_={'version': versions.c.version + 1})
+            .returning(versions.c.symbol, versions.c.version)
+        ).all()
+    ConditionalOrder.query.filter_by(user_id=user_id).delete()
     Transaction.query.filter_by(user_id=user_id).delete()
     PasswordResetToken.query.filter_by(user_id=user_id).delete()
-    UserWallet.query.filter_by(user_id=user_id).delete() # Delete the wallet as well
+    ApiToken.query.filter_by(user_id=user_id).delete()
+    PortfolioRisk.query.filter_by(user_id=user_id).delete()
+    wallets = UserWallet.__table__
+    balance_cents = db.session.execute(
+        delete(wallets).where(wallets.c.user_id == user_id).returning(wallets.c.balance_cents)
+    ).scalar() or 0 # Delete the wallet as well
+    # Whatever the account still holds leaves the system with it
+    post_ledger('account_closed', [(user_id, -balance_cents / 100), (ORDER_ESCROW_ACCOUNT_ID, -forfeited)])
 
     db.session.delete(user)
+    mark_user_changed(user_id)
     db.session.commit()
 
+    # Take the open orders off this process's books, under the same lock matching holds.
+    # A book that missed another change in between is left to reload on its next claim.
+    for symbol, version in bumped:
+        book = get_order_book(symbol)
+        with book.lock:
+            if book.version == version - 1:
+                for order in deleted_orders:
+                    if order.symbol == symbol and order.status == 'open':
+                        book.cancel(order.id)
+                book.version = version
+
     session.pop('user_id', None)
 
     flash('Your account has been successfully deleted.', 'success')
     return redirect(url_for('login'))
 
-# Run the app if this file is executed directly
-if __name__ == '__main__':
-    with app.app_context():
-        print("Creating database tables...")
-        db.create_all()
-        print("Database tables created.")
+# --- JSON API (v1) ---
+# The same operations as the form handlers, for programmatic clients: one request
+# per action, a compact JSON body back and no redirect or template render.
+def hash_api_token(token):
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
 
-        print("Initializing stock prices...")
-        initialize_stock_prices()
-        print("Stock prices initialized.")
+def api_error(message, status=400):
+    return jsonify({'error': message}), status
+
+def api_token_required(f):
+    """Authenticate `Authorization: Bearer <token>` with one indexed lookup and set g.user."""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+        user = None
+        if scheme.lower() == 'bearer' and token:
+            g.api_token_hash = hash_api_token(token.strip())
+            user = db.session.execute(
+                select(User).join(ApiToken, ApiToken.user_id == User.id).where(ApiToken.token_hash == g.api_token_hash)
+            ).scalar()
+        if user is None:
+            return api_error('Missing or invalid API token.', 401)
+        g.user = user
+        return f(*args, **kwargs)
+    return decorated_function
 
-        print("Ensuring Global Exchange account exists...")
-        get_global_exchange_user()
-        print("Global Exchange account ready.")
+def api_payload():
+    payload = request.get_json(silent=True)
+    return payload if isinstance(payload, dict) else {}
+
+@app.route(f'{API_PREFIX}/tokens', methods=['POST'])
+def api_create_token():
+    payload = api_payload()
+    user = User.query.filter_by(username=str(payload.get('username', ''))).first()
+    if not user or not user.check_password(str(payload.get('password', ''))):
+        return api_error('Invalid username or password.', 401)
+    token = secrets.token_urlsafe(32)
+    api_token = ApiToken(user_id=user.id, token_hash=hash_api_token(token), name=str(payload.get('name', ''))[:80])
+    db.session.add(api_token)
+    db.session.commit()
+    return jsonify({'id': api_token.id, 'token': token}), 201
 
+@app.route(f'{API_PREFIX}/tokens/current', methods=['DELETE'])
+@api_token_required
+def api_revoke_token():
+    ApiToken.query.filter_by(token_hash=g.api_token_hash).delete()
+    db.session.commit()
+    return '', 204
+
+@app.route(f'{API_PREFIX}/account')
+@api_token_required
+def api_account():
+    return jsonify({
+        'id': g.user.id,
+        'username': g.user.username,
+        'balance': round(get_user_wallet().balance, 2),
+        'ledger_balance': get_ledger_balance_cents(g.user.id) / 100,
+    })
+
+@app.route(f'{API_PREFIX}/deposit', methods=['POST'])
+@api_token_required
+@retry_on_contention
+def api_deposit():
+    try:
+        amount = parse_amount(api_payload()['amount'])
+        deposit_funds(g.user.id, amount)
+    except (ValueError, TypeError, KeyError):
+        return api_error('Invalid amount.')
+    except TradeError as e:
+        return api_error(str(e))
+    db.session.commit()
+    return jsonify({'amount': amount})
+
+@app.route(f'{API_PREFIX}/withdraw', methods=['POST'])
+@api_token_required
+@retry_on_contention
+def api_withdraw():
+    try:
+        amount = parse_amount(api_payload()['amount'])
+        fee = withdraw_funds(g.user.id, amount)
+    except (ValueError, TypeError, KeyError):
+        return api_error('Invalid amount.')
+    except TradeError as e:
+        return api_error(str(e))
+    db.session.commit()
+    return jsonify({'amount': amount, 'fee': fee})
+
+@app.route(f'{API_PREFIX}/transfer', methods=['POST'])
+@api_token_required
+@retry_on_contention
+def api_transfer():
+    payload = api_payload()
+    try:
+        amount = parse_amount(payload['amount'])
+        recipient_username = str(payload['recipient'])
+        transfer_funds(g.user, recipient_username, amount)
+    except (ValueError, TypeError, KeyError):
+        return api_error('Invalid amount or recipient.')
+    except TradeError as e:
+        return api_error(str(e))
+    db.session.commit()
+    return jsonify({'amount': amount, 'recipient': recipient_username})
+
+def api_market_order(side):
+    payload = api_payload()
+    try:
+        symbol = str(payload['symbol'])
+        quantity = int(payload['quantity'])
+    except (ValueError, TypeError, KeyError):
+        return api_error('Invalid stock or quantity.')
+    trades = TradeBatch(g.user, get_user_wallet())
+    try:
+        result = trades.buy(symbol, quantity) if side == 'buy' else trades.sell(symbol, quantity)
+    except TradeError as e:
+        return api_error(str(e))
+    trades.stage()
+    db.session.commit()
+    return jsonify({**result, 'balance': round(trades.balance, 2)})
+
+@app.route(f'{API_PREFIX}/buy', methods=['POST'])
+@api_token_required
+@retry_on_contention
+def api_buy():
+    return api_market_order('buy')
+
+@app.route(f'{API_PREFIX}/sell', methods=['POST'])
+@api_token_required
+@retry_on_contention
+def api_sell():
+    return api_market_order('sell')
+
+@app.route(f'{API_PREFIX}/orders', methods=['POST'])
+@api_token_required
+@retry_on_contention
+def api_batch_orders():
+    body, status = run_batch_orders(g.user, api_payload())
+    return jsonify(body), status
+
+@app.route(f'{API_PREFIX}/portfolio')
+@api_token_required
+def api_portfolio():
+    return jsonify(portfolio_valuations.get(g.user.id))
+
+@app.route(f'{API_PREFIX}/transactions')
+@api_token_required
+def api_transactions():
+    body, status = history_page(g.user.id, request.args)
+    return jsonify(body), status
+
+# Public market data needs no token; same payload, ETag and ?since= deltas as the dashboard poll
+app.add_url_rule(f'{API_PREFIX}/prices', 'api_prices', get_stock_prices)
+
+# Run the app if this file is executed directly
+if __name__ == '__main__':
+    # One process serves the pages and runs the tick; see DEPLOYMENT.md for gunicorn
+    startup.prepare()
     scheduler = BackgroundScheduler()
-    scheduler.add_job(func=fetch_and_update_stock_prices, trigger='interval', seconds=60)
+    startup.add_jobs(scheduler)
     scheduler.start()
+    startup.start_price_stream()
 
     atexit.register(lambda: scheduler.shutdown())
 
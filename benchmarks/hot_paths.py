@@ -0,0 +1,225 @@
+# Microbenchmarks for the app's hot paths, compared against a stored baseline.
+#
+# Every run builds a fresh SQLite database in a temporary directory, so this never touches
+# database.db. Each case is timed over a fixed number of runs after a warm-up, and its
+# median is compared with benchmarks/baseline.json:
+#
+#     python3 benchmarks/hot_paths.py
+#     python3 benchmarks/hot_paths.py --only tick --repeat-scale 3
+#     python3 benchmarks/hot_paths.py --save-baseline     # after a change you want to keep
+#     python3 benchmarks/hot_paths.py --fail-on-regression --threshold 0.25
+#
+# Baselines are only comparable on the machine that recorded them; re-save one before
+# measuring an optimization on a different box.
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BASELINE = os.path.join(BENCHMARKS_DIR, 'baseline.json')
+
+TICK_UNIVERSES = {9: 200, 1000: 50, 10000: 15}  # universe size -> timed runs
+DASHBOARD_POSITIONS = 500
+BANKING_TRANSACTIONS = 100000
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+def quiet(f, *args, **kwargs):
+    """Call f with the app's startup prints swallowed."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        return f(*args, **kwargs)
+
+def import_app(tmp):
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(tmp, 'bench.db')}"
+    sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+    import app as trading_app
+    with trading_app.app.app_context():
+        quiet(trading_app.migrate_database)
+        trading_app.exchange_account.resolve()
+    quiet(trading_app.initialize_stock_prices)
+    quiet(trading_app.open_ledger)
+    return trading_app
+
+def universe(trading_app, size):
+    extra = [f'SYM{i:05d}' for i in range(max(0, size - len(trading_app.STOCK_SYMBOLS)))]
+    return (trading_app.STOCK_SYMBOLS + extra)[:size]
+
+def logged_in_client(trading_app, username, deposit=1000000):
+    client = trading_app.app.test_client()
+    client.post('/register', data={'username': username, 'password': 'benchmark'})
+    client.post('/login', data={'username': username, 'password': 'benchmark'})
+    client.post('/deposit', data={'amount': deposit})
+    with trading_app.app.app_context():
+        user_id = trading_app.User.query.filter_by(username=username).one().id
+    return client, user_id
+
+def check_ok(response):
+    if response.status_code >= 400:
+        raise RuntimeError(f'{response.request.path} answered {response.status_code}')
+
+# --- Cases ---
+# Each case is a generator: it does its setup, then yields a callable to time, and
+# whatever follows the yield is teardown.
+def case_tick(trading_app, size):
+    quiet(trading_app.initialize_stock_prices, universe(trading_app, size))
+    yield trading_app.fetch_and_update_stock_prices
+    quiet(trading_app.initialize_stock_prices, trading_app.STOCK_SYMBOLS)
+
+def case_buy_sell(trading_app):
+    client, _ = logged_in_client(trading_app, 'bench-trader')
+    def round_trip():
+        check_ok(client.post('/buy_stock', data={'symbol': 'AAPL', 'quantity': 1}))
+        check_ok(client.post('/sell_stock', data={'symbol': 'AAPL', 'quantity': 1}))
+    yield round_trip
+
+def case_load_user(trading_app, cached):
+    from flask import session
+    _, user_id = logged_in_client(trading_app, f'bench-identity-{"warm" if cached else "cold"}')
+    def load():
+        with trading_app.app.test_request_context('/banking_dashboard'):
+            session['user_id'] = user_id
+            if not cached:
+                trading_app.identity_cache.bump([user_id])
+            trading_app.load_logged_in_user()
+            if trading_app.g.user is None:
+                raise RuntimeError('load_logged_in_user found no user')
+    yield load
+
+def case_stock_dashboard(trading_app, positions):
+    symbols = universe(trading_app, positions)
+    quiet(trading_app.initialize_stock_prices, symbols)
+    client, user_id = logged_in_client(trading_app, 'bench-portfolio')
+    with trading_app.app.app_context():
+        trading_app.db.session.execute(trading_app.StockHolding.__table__.insert(), [
+            {'user_id': user_id, 'symbol': symbol, 'quantity': random.randint(1, 500), 'cost_basis': random.uniform(50, 200)}
+            for symbol in symbols
+        ])
+        trading_app.db.session.commit()
+    trading_app.identity_cache.bump([user_id])
+    trading_app.leaderboard.rebuild()
+    yield lambda: check_ok(client.get('/stock_dashboard'))
+    quiet(trading_app.initialize_stock_prices, trading_app.STOCK_SYMBOLS)
+
+def case_banking_dashboard(trading_app, transaction_count):
+    client, user_id = logged_in_client(trading_app, 'bench-banker')
+    _, other_id = logged_in_client(trading_app, 'bench-neighbour')
+    start = datetime.utcnow() - timedelta(days=365)
+    with trading_app.app.app_context():
+        # Half the table belongs to someone else, so the dashboard query has to use the index
+        trading_app.db.session.execute(trading_app.Transaction.__table__.insert(), [
+            {'user_id': user_id if i % 2 else other_id, 'transaction_type': 'Deposit',
+             'amount': round(random.uniform(1, 1000), 2), 'timestamp': start + timedelta(seconds=i * 60)}
+            for i in range(transaction_count)
+        ])
+        trading_app.db.session.commit()
+    yield lambda: check_ok(client.get('/banking_dashboard'))
+
+CASES = (
+    [(f'tick[{size}]', case_tick, (size,), runs) for size, runs in TICK_UNIVERSES.items()]
+    + [
+        ('buy_sell[form]', case_buy_sell, (), 300),
+        ('load_logged_in_user[cached]', case_load_user, (True,), 5000),
+        ('load_logged_in_user[cold]', case_load_user, (False,), 5000),
+        (f'stock_dashboard[{DASHBOARD_POSITIONS} positions]', case_stock_dashboard, (DASHBOARD_POSITIONS,), 30),
+        (f'banking_dashboard[{BANKING_TRANSACTIONS} transactions]', case_banking_dashboard, (BANKING_TRANSACTIONS,), 300),
+    ]
+)
+
+def run_case(trading_app, make_case, case_args, runs):
+    steps = make_case(trading_app, *case_args)
+    f = next(steps)
+    for _ in range(max(1, runs // 10)):
+        f()
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        f()
+        samples.append(time.perf_counter() - started)
+    for _ in steps:
+        pass
+    return {
+        'runs': runs,
+        'median_ms': round(statistics.median(samples) * 1000, 4),
+        'p95_ms': round(percentile(samples, 95) * 1000, 4),
+        'min_ms': round(min(samples) * 1000, 4),
+    }
+
+def compare(results, baseline, threshold):
+    """Print one line per case and return the names that got slower than the threshold allows."""
+    regressions = []
+    print(f"{'case':<44} {'runs':>6} {'median ms':>11} {'p95 ms':>10} {'baseline':>10} {'change':>9}")
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base:
+            change = result['median_ms'] / base['median_ms'] - 1 if base['median_ms'] else 0.0
+            verdict = 'slower' if change > threshold else 'faster' if change < -threshold else ''
+            if verdict == 'slower':
+                regressions.append(name)
+            base_text, change_text = f"{base['median_ms']:>10.3f}", f'{change:>+8.1%} {verdict}'
+        else:
+            base_text, change_text = f"{'-':>10}", f"{'new':>9}"
+        print(f"{name:<44} {result['runs']:>6} {result['median_ms']:>11.3f} {result['p95_ms']:>10.3f} {base_text} {change_text}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the hot paths and compare them with a stored baseline.')
+    parser.add_argument('--only', help='Run only the cases whose name contains this text.')
+    parser.add_argument('--repeat-scale', type=float, default=1.0, help='Multiply every case\'s run count.')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true', help='Write this run\'s results as the new baseline.')
+    parser.add_argument('--threshold', type=float, default=0.25, help='Relative change in the median reported as faster/slower.')
+    parser.add_argument('--fail-on-regression', action='store_true', help='Exit with status 1 if any case got slower.')
+    parser.add_argument('--json', help='Also write this run\'s results to this file.')
+    args = parser.parse_args()
+
+    random.seed(0)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        trading_app = import_app(tmp)
+        for name, make_case, case_args, runs in CASES:
+            if args.only and args.only not in name:
+                continue
+            results[name] = run_case(trading_app, make_case, case_args, max(1, int(runs * args.repeat_scale)))
+        with trading_app.app.app_context():
+            trading_app.db.engine.dispose()
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)['cases']
+    regressions = compare(results, baseline, args.threshold)
+
+    report = {
+        'recorded_at': datetime.utcnow().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'machine': platform.platform(),
+        'cases': results,
+    }
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.save_baseline:
+        # Keep cases this run skipped (--only) so a partial run doesn't drop them
+        report['cases'] = {**baseline, **results}
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+            f.write('\n')
+        print(f'Baseline saved to {args.baseline}')
+    if regressions and args.fail_on_regression:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -9,7 +9,9 @@ import requests
 from flask import Flask, render_template, redirect, url_for, request, session, flash, g, jsonify
 from flask_sqlalchemy import SQLAlchemy
 from apscheduler.schedulers.background import BackgroundScheduler
-from threading import Thread
+from threading import Thread, Lock, BoundedSemaphore
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from collections import deque
 import atexit
 from functools import wraps
 from datetime import datetime, timedelta
@@ -17,6 +19,7 @@ from datetime import datetime, timedelta
 # --- PATCH 1 & 2: Add secure libraries ---
 from flask_bcrypt import Bcrypt
 from flask_wtf.csrf import CSRFProtect
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 # Create the Flask application instance
 app = Flask(__name__)
@@ -24,6 +27,13 @@ app = Flask(__name__)
 # A secret key is required for sessions and flash messages
 app.secret_key = os.environ.get('FLASK_SECRET_KEY', secrets.token_hex(32))
 
+# Number of proxies in front of the app (ngrok is one). Only the X-Forwarded-For entries they
+# appended are trusted, so request.remote_addr is the real client; anything further left is
+# whatever the client chose to send. Set to 0 when the app is exposed directly.
+TRUSTED_PROXY_HOPS = int(os.environ.get('TRUSTED_PROXY_HOPS', 1))
+if TRUSTED_PROXY_HOPS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_HOPS)
+
 # --- PATCH 4 & FIX: Secure Database File Location with Absolute Path ---
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///instance/database.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
@@ -34,6 +44,108 @@ bcrypt = Bcrypt(app)
 csrf = CSRFProtect(app)
 
 
+# --- Password Hashing Pool ---
+# bcrypt is deliberately slow, so hashing and verification run on a small fixed pool
+# instead of in the request thread. A login burst then uses at most PASSWORD_HASH_WORKERS
+# cores, and once PASSWORD_HASH_QUEUE requests are waiting new ones get a 503 right away
+# rather than piling up behind them while trades wait for CPU.
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', 2))
+PASSWORD_HASH_QUEUE = int(os.environ.get('PASSWORD_HASH_QUEUE', 16))
+PASSWORD_HASH_TIMEOUT_SECONDS = 10
+
+password_pool = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix='password-hash')
+password_slots = BoundedSemaphore(PASSWORD_HASH_WORKERS + PASSWORD_HASH_QUEUE)
+
+class HashingBusy(Exception):
+    """The password pool is full; the caller should retry shortly."""
+
+def submit_hashing(fn, *args):
+    """Queue `fn` on the password pool, or raise HashingBusy if it is already full."""
+    if not password_slots.acquire(blocking=False):
+        raise HashingBusy()
+    try:
+        future = password_pool.submit(fn, *args)
+    except RuntimeError:
+        password_slots.release()
+        raise HashingBusy()
+    future.add_done_callback(lambda _: password_slots.release())
+    return future
+
+def run_hashing(fn, *args):
+    try:
+        return submit_hashing(fn, *args).result(timeout=PASSWORD_HASH_TIMEOUT_SECONDS)
+    except FutureTimeout:
+        # Still queued behind a backlog; answer like a full pool instead of a 500
+        raise HashingBusy()
+
+def hash_password(password):
+    return run_hashing(lambda: bcrypt.generate_password_hash(password).decode('utf-8'))
+
+def _verify(password_hash, password):
+    """Returns (matches, is_legacy_hash)."""
+    try:
+        return bcrypt.check_password_hash(password_hash, password), False
+    except ValueError:
+        # Accounts created before bcrypt still carry an unsalted SHA-256 hex digest
+        return secrets.compare_digest(hashlib.sha256(password.encode('utf-8')).hexdigest(), password_hash), True
+
+def _upgrade_legacy_hash(user_id, legacy_hash, password):
+    new_hash = bcrypt.generate_password_hash(password).decode('utf-8')
+    with app.app_context():
+        # Only replace the hash we verified, in case the password changed in the meantime
+        User.query.filter_by(id=user_id, password_hash=legacy_hash).update({'password_hash': new_hash})
+        db.session.commit()
+
+def schedule_legacy_upgrade(user_id, legacy_hash, password):
+    """Rehash a legacy password with bcrypt in the background; skipped (until next login) if the pool is busy."""
+    try:
+        submit_hashing(_upgrade_legacy_hash, user_id, legacy_hash, password)
+    except HashingBusy:
+        pass
+
+# --- Login Attempt Limiter ---
+# The per-IP limit is checked first, before the user lookup and any hashing, so a flood is turned away
+# for the cost of a dict lookup. Only an attempt that passes it is charged to the account, and only to
+# an account that exists: a blocked IP can't spend someone else's budget, and a spray of made-up
+# usernames creates no keys.
+LOGIN_WINDOW_SECONDS = 60
+LOGIN_ATTEMPTS_PER_USERNAME = 10
+LOGIN_ATTEMPTS_PER_IP = 30
+
+class LoginRateLimiter:
+    """Sliding-window attempt counter per key, e.g. ('ip', address) or ('user', user_id)."""
+    MAX_KEYS = 100000
+
+    def __init__(self, window=LOGIN_WINDOW_SECONDS):
+        self.window = window
+        self.attempts = {}
+        self.lock = Lock()
+
+    def allow(self, key, limit):
+        now = time.monotonic()
+        with self.lock:
+            attempts = self.attempts.get(key)
+            if attempts is None:
+                if len(self.attempts) >= self.MAX_KEYS:
+                    self._prune(now)
+                attempts = self.attempts[key] = deque()
+            while attempts and attempts[0] <= now - self.window:
+                attempts.popleft()
+            if len(attempts) >= limit:
+                return False
+            attempts.append(now)
+            return True
+
+    def _prune(self, now):
+        for key in [key for key, attempts in self.attempts.items() if not attempts or attempts[-1] <= now - self.window]:
+            del self.attempts[key]
+
+login_limiter = LoginRateLimiter()
+
+def client_address():
+    # ProxyFix has already replaced the proxy's address with the hop it appended to X-Forwarded-For
+    return request.remote_addr
+
 # --- Stock Market API Configuration ---
 STOCK_SYMBOLS = ['AAPL', 'GOOG', 'MSFT', 'AMZN', 'TSLA', 'NFLX', 'SBUX', 'NKE', 'KO']
 STOCK_NAMES = {
@@ -67,20 +179,13 @@ class User(db.Model):
     wallet = db.relationship('UserWallet', backref='user', uselist=False)
 
     def set_password(self, password):
-        self.password_hash = bcrypt.generate_password_hash(password).decode('utf-8')
+        self.password_hash = hash_password(password)
 
     def check_password(self, password):
-        try:
-            if bcrypt.check_password_hash(self.password_hash, password):
-                return True
-        except ValueError:
-            old_hash = hashlib.sha256(password.encode('utf-8')).hexdigest()
-            if old_hash == self.password_hash:
-                self.set_password(password)
-                db.session.add(self)
-                db.session.commit()
-                return True
-        return False
+        matches, legacy = run_hashing(_verify, self.password_hash, password)
+        if matches and legacy:
+            schedule_legacy_upgrade(self.id, self.password_hash, password)
+        return matches
 
 class UserWallet(db.Model):
     __tablename__ = 'user_wallets'
@@ -224,13 +329,32 @@ def register():
             return redirect(url_for('login'))
     return render_template('register.html')
 
+@app.errorhandler(HashingBusy)
+def handle_hashing_busy(error):
+    db.session.rollback()
+    flash('The server is busy. Please try again in a moment.', 'error')
+    response = redirect(request.referrer or url_for('login'))
+    response.headers['Retry-After'] = '2'
+    return response
+
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
+        if not login_limiter.allow(('ip', client_address()), LOGIN_ATTEMPTS_PER_IP):
+            flash('Too many login attempts. Please wait a minute and try again.', 'error')
+            return render_template('login.html'), 429, {'Retry-After': str(LOGIN_WINDOW_SECONDS)}
         user = User.query.filter_by(username=username).first()
-        if user and user.check_password(password):
+        if user is not None and not login_limiter.allow(('user', user.id), LOGIN_ATTEMPTS_PER_USERNAME):
+            flash('Too many login attempts. Please wait a minute and try again.', 'error')
+            return render_template('login.html'), 429, {'Retry-After': str(LOGIN_WINDOW_SECONDS)}
+        try:
+            authenticated = user is not None and user.check_password(password)
+        except HashingBusy:
+            flash('The server is busy. Please try again in a moment.', 'error')
+            return render_template('login.html'), 503, {'Retry-After': '2'}
+        if authenticated:
             session['user_id'] = user.id
             return redirect(url_for('banking_dashboard'))
         else:
@@ -0,0 +1,310 @@
+# Load generator for the Stock Trading Simulator.
+#
+# Simulated traders register, deposit, buy and sell across the app's symbols and poll
+# prices, each on its own thread. At the end it prints throughput and p50/p95/p99 latency
+# per route. Form routes redirect whatever the outcome, so each form action also fetches
+# the page it redirects to and counts an error flash there as a rejection. With no --url it runs in-process against app.py through the Flask test client,
+# on a throwaway SQLite database with the price tick running, so it never touches database.db:
+#
+#     python3 load_test.py
+#     python3 load_test.py --users 50 --seconds 30 --rate 200 --mix buy=3,sell=2,prices=10
+#     python3 load_test.py --api --json results.json
+#
+# Or point it at a running server (python3 app.py, gunicorn, ...). This registers real
+# accounts there, so use a scratch database:
+#
+#     python3 load_test.py --url http://127.0.0.1:5000 --users 20
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+import uuid
+from threading import Thread, Event, Lock
+from urllib.parse import urlsplit
+
+DEFAULT_MIX = 'buy=4,sell=3,prices=10,deposit=1,portfolio=1,dashboard=1'
+# base.html renders each flashed message as <li class="{{ category }}">
+FLASH_CATEGORY = re.compile(r'<ul class="flashes">(.*?)</ul>', re.S)
+FLASH_ITEM = re.compile(r'<li class="(\w+)">')
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name not in ACTIONS:
+            raise argparse.ArgumentTypeError(f'Unknown action "{name}". Use: {", ".join(ACTIONS)}.')
+        mix[name] = float(weight or 1)
+    return mix
+
+class TestClientTransport:
+    """Requests through the Flask test client; one instance (and cookie jar) per trader."""
+    def __init__(self, flask_app):
+        self.client = flask_app.test_client()
+
+    def request(self, method, path, data=None, json=None, headers=None):
+        """Return (status, JSON body or None, page text or None, redirect location or None)."""
+        response = self.client.open(path, method=method, data=data, json=json, headers=headers)
+        body = response.get_json(silent=True) if response.is_json else None
+        text = response.get_data(as_text=True) if response.mimetype == 'text/html' else None
+        response.close()
+        return response.status_code, body, text, response.headers.get('Location')
+
+class HttpTransport:
+    def __init__(self, base_url):
+        import requests
+        self.base_url = base_url.rstrip('/')
+        self.session = requests.Session()
+
+    def request(self, method, path, data=None, json=None, headers=None):
+        # Form handlers answer with a redirect; time the action, not the page it points to
+        response = self.session.request(method, self.base_url + path, data=data, json=json, headers=headers,
+                                        allow_redirects=False, timeout=30)
+        content_type = response.headers.get('Content-Type', '')
+        body = response.json() if content_type.startswith('application/json') else None
+        text = response.text if content_type.startswith('text/html') else None
+        return response.status_code, body, text, response.headers.get('Location')
+
+class Stats:
+    def __init__(self):
+        self.lock = Lock()
+        self.routes = {}
+
+    def record(self, route, elapsed, status, rejected=False):
+        with self.lock:
+            entry = self.routes.setdefault(route, {'latencies': [], 'rejected': 0, 'errors': 0})
+            entry['latencies'].append(elapsed)
+            if status is None or status >= 500:
+                entry['errors'] += 1
+            elif status >= 400 or rejected:
+                entry['rejected'] += 1
+
+    def summary(self, seconds):
+        report = {}
+        for route, entry in sorted(self.routes.items()):
+            latencies = entry['latencies']
+            report[route] = {
+                'requests': len(latencies),
+                'per_second': round(len(latencies) / seconds, 1),
+                'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+                'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+                'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+                'max_ms': round(max(latencies, default=0.0) * 1000, 2),
+                'rejected': entry['rejected'],
+                'errors': entry['errors'],
+            }
+        return report
+
+class Trader:
+    """One simulated user. Form mode uses the browser's routes and session cookie; API mode uses /api/v1."""
+    def __init__(self, transport, stats, symbols, api):
+        self.transport = transport
+        self.stats = stats
+        self.symbols = symbols
+        self.api = api
+        self.username = f'load-{uuid.uuid4().hex[:12]}'
+        self.headers = None
+        self.holdings = {}
+        self.price_seq = 0
+
+    def call(self, method, path, route=None, follow=False, **kwargs):
+        """Time one request and return (succeeded, JSON body).
+
+        Form handlers answer every outcome with a redirect and a flashed
+        message. With follow=True the redirect is fetched like a browser
+        would, timed as its own route, and an "error" flash on that page
+        counts the action as rejected.
+        """
+        started = time.perf_counter()
+        try:
+            status, body, _, location = self.transport.request(method, path, headers=self.headers, **kwargs)
+        except Exception:
+            status, body, location = None, None, None
+        elapsed = time.perf_counter() - started
+        rejected = False
+        if follow and status == 302 and location:
+            rejected = 'error' in self.follow(location)
+        self.stats.record(route or f'{method} {path}', elapsed, status, rejected)
+        return status is not None and status < 400 and not rejected, body
+
+    def follow(self, location):
+        """GET a redirect target, record it, and return the categories flashed on it."""
+        target = urlsplit(location)
+        path = target.path + (f'?{target.query}' if target.query else '')
+        started = time.perf_counter()
+        try:
+            status, _, text, _ = self.transport.request('GET', path, headers=self.headers)
+        except Exception:
+            status, text = None, None
+        self.stats.record(f'GET {target.path}', time.perf_counter() - started, status)
+        flashes = FLASH_CATEGORY.search(text or '')
+        return FLASH_ITEM.findall(flashes.group(1)) if flashes else []
+
+    def sign_up(self, opening_deposit):
+        password = uuid.uuid4().hex
+        self.call('POST', '/register', data={'username': self.username, 'password': password})
+        if self.api:
+            ok, body = self.call('POST', '/api/v1/tokens', json={'username': self.username, 'password': password, 'name': 'load_test'})
+            if ok:
+                self.headers = {'Authorization': f'Bearer {body["token"]}'}
+        else:
+            self.call('POST', '/login', data={'username': self.username, 'password': password}, follow=True)
+        self.deposit(opening_deposit)
+
+    def deposit(self, amount=None):
+        amount = round(amount or random.uniform(100, 1000), 2)
+        if self.api:
+            self.call('POST', '/api/v1/deposit', json={'amount': amount})
+        else:
+            self.call('POST', '/deposit', data={'amount': amount}, follow=True)
+
+    def buy(self):
+        symbol = random.choice(self.symbols)
+        quantity = random.randint(1, 10)
+        if self.api:
+            ok, _ = self.call('POST', '/api/v1/buy', json={'symbol': symbol, 'quantity': quantity})
+        else:
+            ok, _ = self.call('POST', '/buy_stock', data={'symbol': symbol, 'quantity': quantity}, follow=True)
+        if ok:
+            self.holdings[symbol] = self.holdings.get(symbol, 0) + quantity
+
+    def sell(self):
+        held = [symbol for symbol, quantity in self.holdings.items() if quantity > 0]
+        if not held:
+            return self.buy()
+        symbol = random.choice(held)
+        quantity = random.randint(1, self.holdings[symbol])
+        if self.api:
+            ok, _ = self.call('POST', '/api/v1/sell', json={'symbol': symbol, 'quantity': quantity})
+        else:
+            ok, _ = self.call('POST', '/sell_stock', data={'symbol': symbol, 'quantity': quantity}, follow=True)
+        if ok:
+            self.holdings[symbol] -= quantity
+
+    def prices(self):
+        # Poll like the dashboard does: deltas since the last sequence number seen
+        ok, body = self.call('GET', f'/get_stock_prices?since={self.price_seq}', route='GET /get_stock_prices')
+        if ok and body:
+            self.price_seq = body.get('seq', self.price_seq)
+
+    def portfolio(self):
+        self.call('GET', '/api/v1/portfolio' if self.api else '/portfolio_valuation')
+
+    def dashboard(self):
+        self.call('GET', '/api/v1/account' if self.api else '/stock_dashboard')
+
+ACTIONS = {
+    'buy': Trader.buy,
+    'sell': Trader.sell,
+    'prices': Trader.prices,
+    'deposit': Trader.deposit,
+    'portfolio': Trader.portfolio,
+    'dashboard': Trader.dashboard,
+}
+
+def run_trader(trader, args, mix, start_at, stop):
+    # Spread sign-ups over the ramp so they don't all land in the first instant
+    delay = start_at - time.monotonic()
+    if delay > 0 and stop.wait(delay):
+        return
+    trader.sign_up(args.opening_deposit)
+    actions, weights = zip(*mix.items())
+    per_user_rate = args.rate / args.users if args.rate else 0
+    while not stop.is_set():
+        ACTIONS[random.choices(actions, weights)[0]](trader)
+        if per_user_rate:
+            # Poisson arrivals at the requested aggregate rate
+            stop.wait(random.expovariate(per_user_rate))
+
+def start_in_process(args):
+    """Import app.py against a temporary SQLite database and start the price tick."""
+    tmp = tempfile.mkdtemp(prefix='load_test_')
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(tmp, 'load_test.db')}"
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app as trading_app
+
+    with trading_app.app.app_context():
+        trading_app.migrate_database()
+        trading_app.initialize_stock_prices()
+        trading_app.load_order_books()
+        trading_app.exchange_account.resolve()
+        trading_app.leaderboard.rebuild()
+        trading_app.open_ledger()
+
+    stop = Event()
+    def tick():
+        while not stop.wait(args.tick_seconds):
+            trading_app.fetch_and_update_stock_prices()
+    Thread(target=tick, daemon=True).start()
+    print(f"In-process run on {os.environ['DATABASE_URL']}")
+    return trading_app, stop
+
+def main():
+    parser = argparse.ArgumentParser(description='Run simulated traders against the app and report latency per route.')
+    parser.add_argument('--url', help='Base URL of a running server. Without it the app runs in-process.')
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--seconds', type=float, default=10.0, help='How long to run after the ramp-up.')
+    parser.add_argument('--ramp', type=float, default=1.0, help='Seconds over which traders sign up.')
+    parser.add_argument('--rate', type=float, default=0.0, help='Target requests per second across all traders (0 = as fast as possible).')
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX, help=f'Weighted actions (default {DEFAULT_MIX}).')
+    parser.add_argument('--api', action='store_true', help='Use the /api/v1 JSON API instead of the HTML form routes.')
+    parser.add_argument('--opening-deposit', type=float, default=100000.0)
+    parser.add_argument('--tick-seconds', type=float, default=1.0, help='Price tick interval for in-process runs.')
+    parser.add_argument('--json', help='Also write the report to this file.')
+    args = parser.parse_args()
+    mix = args.mix
+
+    ticker_stop = None
+    if args.url:
+        make_transport = lambda: HttpTransport(args.url)
+        symbols = sorted(HttpTransport(args.url).request('GET', '/get_stock_prices?since=0')[1]['prices'])
+    else:
+        trading_app, ticker_stop = start_in_process(args)
+        make_transport = lambda: TestClientTransport(trading_app.app)
+        symbols = trading_app.STOCK_SYMBOLS
+
+    stats = Stats()
+    stop = Event()
+    now = time.monotonic()
+    threads = [
+        Thread(target=run_trader, args=(Trader(make_transport(), stats, symbols, args.api), args, mix,
+                                        now + args.ramp * i / args.users, stop))
+        for i in range(args.users)
+    ]
+    for thread in threads:
+        thread.start()
+    time.sleep(args.ramp)
+    # Only the steady state counts towards the report
+    with stats.lock:
+        stats.routes.clear()
+    started = time.monotonic()
+    time.sleep(args.seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+    if ticker_stop:
+        ticker_stop.set()
+
+    report = stats.summary(elapsed)
+    total = sum(route['requests'] for route in report.values())
+    print(f"{args.users} traders, {elapsed:.1f}s, {total} requests, {total / elapsed:.1f} req/s ({'api' if args.api else 'forms'})")
+    print(f"{'route':<32} {'req':>7} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8} {'4xx':>5} {'err':>5}")
+    for route, row in report.items():
+        print(f"{route:<32} {row['requests']:>7} {row['per_second']:>8.1f} {row['p50_ms']:>8.2f} {row['p95_ms']:>8.2f}"
+              f" {row['p99_ms']:>8.2f} {row['max_ms']:>8.2f} {row['rejected']:>5} {row['errors']:>5}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'users': args.users, 'seconds': elapsed, 'api': args.api, 'routes': report}, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+# A local stand-in for an external market-data API.
+# Run it, then start the app with QUOTE_PROVIDER=http to exercise HttpQuoteProvider offline:
+#
+#     python3 quote_stub_server.py --port 5001
+#     QUOTE_PROVIDER=http QUOTE_PROVIDER_URL=http://127.0.0.1:5001 python3 app.py
+import argparse
+import random
+import time
+from threading import Lock
+from flask import Flask, request, jsonify
+
+app = Flask(__name__)
+
+# Knobs for testing the client's timeouts and fallback path
+settings = {'latency': 0.0, 'fail_rate': 0.0}
+quotes = {}
+quotes_lock = Lock()
+
+def next_quote(symbol):
+    price = quotes.get(symbol)
+    if price is None:
+        price = random.uniform(50.0, 200.0)
+    else:
+        price = max(1.0, price * (1 + random.uniform(-0.02, 0.02)))
+    quotes[symbol] = price
+    return round(price, 2)
+
+@app.route('/quotes')
+def get_quotes():
+    if settings['latency']:
+        time.sleep(settings['latency'])
+    if random.random() < settings['fail_rate']:
+        return jsonify({'error': 'Simulated upstream failure.'}), 503
+    symbols = [symbol for symbol in request.args.get('symbols', '').split(',') if symbol]
+    with quotes_lock:
+        return jsonify({'quotes': {symbol: next_quote(symbol) for symbol in symbols}, 'as_of': time.time()})
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve simulated quotes for the Stock Trading Simulator.')
+    parser.add_argument('--port', type=int, default=5001)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds to sleep before each response.')
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='Fraction of requests answered with HTTP 503.')
+    args = parser.parse_args()
+    settings['latency'] = args.latency
+    settings['fail_rate'] = args.fail_rate
+    app.run(port=args.port, threaded=True)